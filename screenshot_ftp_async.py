@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+截图FTP上传工具 - asyncio上传
+ftplib每个会话同一时间只能进行一次传输，并发上传需要每个上传占用一个线程。这里在一个后台线程中
+运行事件循环，FTP控制连接和被动模式（EPSV/PASV）数据连接都由协程完成：一批截图同时通过多个会话上传，
+上传线程只需提交协程并等待结果，界面通知仍由流水线的Qt信号发出。
+"""
+import asyncio
+import os
+import time
+import socket
+import posixpath
+import threading
+import contextlib
+from ftplib import error_perm, error_temp, error_reply, error_proto, parse227, parse229
+from screenshot_ftp_nanAn_kylin import FTPUploader, BandwidthLimiter
+
+class AsyncFTPEngine:
+    """后台事件循环线程，所有asyncio上传目标共用；其它线程通过 run() 提交协程并等待结果"""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="ftp-asyncio", daemon=True)
+        self.thread.start()
+    
+    def is_running(self):
+        return self.thread is not None
+    
+    def run(self, coroutine, timeout=None):
+        """在事件循环中执行协程，阻塞等待其结果"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+    
+    def close(self):
+        """停止事件循环并等待线程退出"""
+        if not self.thread:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+        self.loop.close()
+
+class AsyncFTPSession:
+    """一个FTP控制连接，命令的响应与ftplib一致: 4xx抛出error_temp，5xx抛出error_perm"""
+    def __init__(self, encoding="gbk", timeout=30):
+        self.encoding = encoding
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.peer = None
+        # 已切换到的工作目录，工作目录变化后会话不再复用
+        self.directory = None
+        self.last_used = 0.0
+        # 服务器不支持EPSV时改用PASV
+        self.epsv = True
+    
+    async def _wait(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout("FTP服务器响应超时")
+    
+    async def connect(self, host, port):
+        self.reader, self.writer = await self._wait(asyncio.open_connection(host, port))
+        self.peer = self.writer.get_extra_info("peername")
+        return await self.response()
+    
+    async def _readline(self):
+        line = await self._wait(self.reader.readline())
+        if not line:
+            raise EOFError
+        return line.decode(self.encoding).rstrip("\r\n")
+    
+    async def response(self):
+        """读取一个（可能多行的）响应"""
+        response = await self._readline()
+        if response[3:4] == "-":
+            code = response[:3]
+            while True:
+                line = await self._readline()
+                response += "\n" + line
+                if line[:3] == code and line[3:4] != "-":
+                    break
+        if response[:1] == "4":
+            raise error_temp(response)
+        if response[:1] == "5":
+            raise error_perm(response)
+        if response[:1] not in ("1", "2", "3"):
+            raise error_proto(response)
+        return response
+    
+    async def command(self, line, expect="2"):
+        """发送命令，响应不以expect开头时抛出error_reply"""
+        self.writer.write((line + "\r\n").encode(self.encoding))
+        await self.writer.drain()
+        response = await self.response()
+        if not response.startswith(expect):
+            raise error_reply(response)
+        return response
+    
+    async def login(self, user, password):
+        response = await self.command(f"USER {user}", ("2", "3"))
+        if response[:1] == "3":
+            await self.command(f"PASS {password}")
+    
+    async def cwd(self, directory):
+        await self.command(f"CWD {directory}")
+        self.directory = directory
+    
+    async def size(self, name):
+        await self.command("TYPE I")
+        response = await self.command(f"SIZE {name}", "213")
+        return int(response[3:].strip())
+    
+    async def rename(self, source, target):
+        await self.command(f"RNFR {source}", "3")
+        await self.command(f"RNTO {target}")
+    
+    async def open_data(self):
+        """打开被动模式数据连接，优先使用EPSV；与ftplib一样不信任PASV响应中的地址"""
+        if self.epsv:
+            try:
+                host, port = parse229(await self.command("EPSV", "229"), self.peer)
+            except error_perm:
+                self.epsv = False
+        if not self.epsv:
+            _, port = parse227(await self.command("PASV", "227"))
+            host = self.peer[0]
+        return await self._wait(asyncio.open_connection(host, port))
+    
+    async def store(self, command, source, blocksize, limiter=None, priority=BandwidthLimiter.INTERACTIVE):
+        """STOR/APPE，从source读取并发送；限速器在线程池中等待令牌（可能与其它上传线程共用）。
+        返回数据发送完毕的时间，之后等待的是服务器确认"""
+        await self.command("TYPE I")
+        _, writer = await self.open_data()
+        try:
+            await self.command(command, "1")
+            loop = asyncio.get_running_loop()
+            while True:
+                block = source.read(blocksize)
+                if not block:
+                    break
+                if limiter:
+                    await loop.run_in_executor(None, limiter.acquire, len(block), priority)
+                writer.write(block)
+                await self._wait(writer.drain())
+            eof_time = time.monotonic()
+        finally:
+            writer.close()
+            with contextlib.suppress(OSError):
+                await writer.wait_closed()
+        response = await self.response()
+        if not response.startswith("2"):
+            raise error_reply(response)
+        return eof_time
+    
+    async def quit(self):
+        try:
+            await self.command("QUIT")
+        except Exception:
+            pass
+        self.close()
+    
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+class AsyncFTPUploader(FTPUploader):
+    """与FTPUploader接口相同，批量上传在事件循环中进行：一批截图同时通过最多concurrency个会话上传。
+    连接测试、目录验证和流式上传仍使用ftplib"""
+    def __init__(self, engine, host, user, password, logger, metrics=None, blocksize=64 * 1024, port=21,
+                 name="primary", concurrency=4):
+        super().__init__(host, user, password, logger, metrics, blocksize, port, name)
+        self.engine = engine
+        self.concurrency = concurrency
+        # 空闲会话和并发上限，只在事件循环线程中访问
+        self.sessions = []
+        self.semaphore = None
+    
+    async def _connect(self):
+        """建立新会话：连接、登录并切换到工作目录"""
+        self.logger.info(f"正在连接FTP服务器: {self.host}")
+        session = AsyncFTPSession(self.pool.encoding, self.pool.timeout)
+        start = time.monotonic()
+        await session.connect(self.host, self.port)
+        connected = time.monotonic()
+        try:
+            await session.login(self.user, self.password)
+            self.logger.info("FTP登录成功")
+            logged_in = time.monotonic()
+            await session.cwd(self.working_directory)
+            if self.metrics:
+                self.metrics.observe("connect", connected - start)
+                self.metrics.observe("login", logged_in - connected)
+                self.metrics.observe("cwd", time.monotonic() - logged_in)
+        except Exception:
+            session.close()
+            raise
+        return session
+    
+    async def _acquire(self):
+        """取出一个可用会话，空闲过久的会话先用NOOP检查是否存活"""
+        while self.sessions:
+            session = self.sessions.pop()
+            if session.directory != self.working_directory:
+                await session.quit()
+                continue
+            if time.monotonic() - session.last_used < self.pool.keepalive_interval:
+                return session
+            try:
+                await session.command("NOOP")
+                return session
+            except Exception:
+                # 服务器已超时断开
+                session.close()
+        return await self._connect()
+    
+    async def _release(self, session):
+        if len(self.sessions) < self.concurrency:
+            session.last_used = time.monotonic()
+            self.sessions.append(session)
+        else:
+            await session.quit()
+    
+    async def _ensure_directory_async(self, session, directory):
+        if not directory or directory in self.known_directories:
+            return
+        path = ""
+        for part in directory.split("/"):
+            path = posixpath.join(path, part)
+            try:
+                await session.command(f"MKD {path}")
+            except error_perm:
+                # 目录已存在
+                pass
+        self.known_directories.add(directory)
+    
+    async def _rename_async(self, session, source, target):
+        try:
+            await session.rename(source, target)
+        except error_perm:
+            # 部分服务器不允许覆盖已有文件
+            await session.command(f"DELE {target}")
+            await session.rename(source, target)
+    
+    async def _store_async(self, session, filename, source, priority):
+        """与 FTPUploader._store 相同: 上传到临时文件后改名，中断过的文件用APPE继续"""
+        await self._ensure_directory_async(session, posixpath.dirname(filename))
+        temp_name = self.temp_name(filename)
+        offset = total = 0
+        if filename in self.partial_uploads:
+            try:
+                offset = await session.size(temp_name)
+            except error_perm:
+                offset = 0
+            total = source.seek(0, os.SEEK_END)
+            if not 0 < offset <= total:
+                offset = 0
+            elif offset < total:
+                self.logger.info(f"从 {offset} 字节处继续上传: {filename}")
+            if offset and self.metrics:
+                self.metrics.record_resumed(offset)
+        source.seek(offset)
+        
+        start = time.monotonic()
+        self.partial_uploads.add(filename)
+        eof_time = None
+        if offset == 0 or offset < total:
+            eof_time = await session.store(f'{"APPE" if offset else "STOR"} {temp_name}', source, self.blocksize,
+                                           self.limiter, priority)
+        end = time.monotonic()
+        if self.limiter and eof_time:
+            self.limiter.record_rtt(end - eof_time)
+        await self._rename_async(session, temp_name, filename)
+        self.partial_uploads.discard(filename)
+        return end - start, source.tell() - offset
+    
+    async def _upload_file(self, filename, image_data, priority):
+        """上传一个文件，会话失效时重新连接后重试一次，返回是否成功"""
+        async with self.semaphore:
+            self.logger.info(f"开始上传图片: {filename}")
+            for attempt in range(2):
+                try:
+                    session = await self._acquire()
+                except Exception as e:
+                    self.logger.error(f"FTP连接错误: {e}")
+                    return False
+                
+                try:
+                    seconds, sent = await self._store_async(session, filename, image_data, priority)
+                    if self.metrics:
+                        self.metrics.record_transfer(sent, seconds)
+                except (error_temp, EOFError, OSError) as e:
+                    # 421、超时或连接被服务器关闭，重新连接后重试一次
+                    session.close()
+                    if attempt == 0:
+                        self.logger.warning(f"FTP会话已失效，重新连接: {e}")
+                        continue
+                    self.logger.error(f"FTP上传错误: {e}")
+                    return False
+                except error_perm as e:
+                    await self._release(session)
+                    directory = posixpath.dirname(filename)
+                    if attempt == 0 and str(e).startswith("550") and directory in self.known_directories:
+                        # 子目录可能已在服务器上被删除，重新创建后重试
+                        self.logger.warning(f"上传目录不可用，重新创建: {directory}")
+                        self.known_directories.discard(directory)
+                        continue
+                    self.logger.error(f"FTP上传错误: {e}")
+                    return False
+                except Exception as e:
+                    session.close()
+                    self.logger.error(f"FTP上传错误: {e}")
+                    return False
+                
+                await self._release(session)
+                self.logger.success(f"文件上传成功: {filename}")
+                return True
+            return False
+    
+    async def _upload_files(self, files, priority):
+        if self.semaphore is None:
+            # Python 3.8 中Semaphore绑定创建时的事件循环，须在事件循环线程中创建
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return list(await asyncio.gather(*(self._upload_file(filename, data, priority) for filename, data in files)))
+    
+    def _upload_batch(self, files, priority):
+        return self.engine.run(self._upload_files(files, priority))
+    
+    async def _close_sessions(self):
+        sessions, self.sessions = self.sessions, []
+        for session in sessions:
+            await session.quit()
+    
+    def close(self):
+        """关闭ftplib会话和事件循环中的空闲会话"""
+        super().close()
+        if self.engine.is_running():
+            self.engine.run(self._close_sessions())
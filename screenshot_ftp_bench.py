@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+"""
+截图FTP上传工具 - 性能测试
+在本机启动模拟FTP服务器（需要pyftpdlib），用合成截图走一遍 抓图→编码→上传 流程，
+统计吞吐量、延迟分位数和每张截图的CPU/内存占用，不依赖生产服务器。
+可保存基准结果，之后的测试结果与基准对比，发现性能退化时返回非零退出码。
+"""
+import sys
+import os
+import io
+import time
+import json
+import random
+import subprocess
+import shutil
+import tempfile
+import threading
+from PyQt5.QtCore import Qt
+from screenshot_ftp_nanAn_kylin import (Logger, FTPUploader, BandwidthLimiter, ScreenshotManager, ImageEncoder,
+                                        FrameBudget, UploadSpool, UploadPipeline, PipelineMetrics, print_log,
+                                        qimage_to_pil)
+
+# 测试用的截图尺寸
+DEFAULT_SIZES = ((1366, 768), (1920, 1080), (3840, 2160))
+
+# 基准对比的指标: 指标 -> 数值越大越好
+BASELINE_METRICS = {
+    "captures_per_second": True,
+    "throughput_kb": True,
+    "latency_p50_ms": False,
+    "latency_p95_ms": False,
+    "encode_p50_ms": False,
+    "cpu_ms_per_capture": False,
+    "peak_rss_mb": False,
+    "startup_p50_ms": False,
+    "convert_p50_ms": False,
+}
+# 启动测试: 场景 -> 在新进程中执行的代码，startup-python 为解释器本身的启动耗时
+STARTUP_SCENARIOS = {
+    "startup-python": "pass",
+    "startup-core": "import screenshot_ftp_nanAn_kylin",
+    "startup-gui": "import screenshot_ftp_gui",
+}
+# QImage测试的格式: 剪贴板和屏幕抓取常见的 RGB32/ARGB32 需要PIL解包，RGBA8888 直接映射
+QIMAGE_FORMATS = ("RGB32", "ARGB32", "RGBA8888")
+# 耗时类指标在本机上只有几毫秒时波动很大，差值小于此值时不算退化
+MIN_REGRESSION_MS = 10.0
+
+class LocalFTPServer:
+    """本机模拟FTP服务器，可注入命令延迟、带宽限制和上传失败"""
+    USER = "bench"
+    PASSWORD = "bench"
+    
+    def __init__(self, root=None, latency=0.0, bandwidth=None, failure_rate=0.0, encoding="gbk",
+                 directory="南安", drop_rate=0.0):
+        # latency: 每条命令的延迟（秒），bandwidth: 上传速率上限（字节/秒），failure_rate: STOR失败的概率，
+        # drop_rate: 每次接收数据后断开会话的概率（模拟上传中途断线）
+        self.root = root or tempfile.mkdtemp(prefix="ftp-bench-")
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.encoding = encoding
+        self.directory = directory
+        self.host = "127.0.0.1"
+        self.port = None
+        self.server = None
+        self.thread = None
+    
+    def start(self):
+        try:
+            from pyftpdlib.authorizers import DummyAuthorizer
+            from pyftpdlib.handlers import FTPHandler, DTPHandler
+            from pyftpdlib.servers import ThreadedFTPServer
+        except ImportError:
+            raise RuntimeError("性能测试需要安装pyftpdlib: pip install pyftpdlib")
+        
+        os.makedirs(os.path.join(self.root, self.directory), exist_ok=True)
+        settings = self
+        
+        class BenchDTPHandler(DTPHandler):
+            def handle_read(self):
+                received = self.tot_bytes_received
+                super().handle_read()
+                # 每个连接在独立线程中运行，按接收的字节数休眠即可模拟带宽
+                if settings.bandwidth:
+                    time.sleep((self.tot_bytes_received - received) / settings.bandwidth)
+                if settings.drop_rate and random.random() < settings.drop_rate:
+                    # 已收到的数据保留在服务器上
+                    self.cmd_channel.close()
+            
+            # DTPHandler 将 handle_read_event 直接指向了自己的 handle_read
+            handle_read_event = handle_read
+        
+        class BenchFTPHandler(FTPHandler):
+            def pre_process_command(self, line, cmd, arg):
+                if settings.latency:
+                    time.sleep(settings.latency)
+                if cmd in ("STOR", "APPE") and settings.failure_rate and random.random() < settings.failure_rate:
+                    # 模拟服务器断开会话
+                    self.respond("421 Injected failure, closing control connection.")
+                    self.close_when_done()
+                    return
+                super().pre_process_command(line, cmd, arg)
+        
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(self.USER, self.PASSWORD, self.root, perm="elradfmwMT")
+        BenchFTPHandler.authorizer = authorizer
+        BenchFTPHandler.dtp_handler = BenchDTPHandler
+        BenchFTPHandler.encoding = self.encoding
+        BenchFTPHandler.banner = "screenshot-ftp-uploader bench"
+        
+        # 不使用pyftpdlib默认的逐条命令日志
+        import logging
+        server_logger = logging.getLogger("pyftpdlib")
+        server_logger.setLevel(logging.WARNING)
+        if not server_logger.handlers:
+            server_logger.addHandler(logging.NullHandler())
+        self.server = ThreadedFTPServer((self.host, 0), BenchFTPHandler)
+        self.port = self.server.address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"handle_exit": False},
+                                       name="bench-ftp-server", daemon=True)
+        self.thread.start()
+        return self
+    
+    def uploaded_files(self):
+        return os.listdir(os.path.join(self.root, self.directory))
+    
+    def close(self):
+        if self.server:
+            self.server.close_all()
+            self.server = None
+        shutil.rmtree(self.root, ignore_errors=True)
+
+def make_synthetic_image(width, height, seed=0):
+    """生成类似桌面截图的图像：大块纯色窗口、文字行和一块带噪点的图片区域"""
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    image = Image.new("RGB", (width, height), (rng.randint(40, 80), rng.randint(80, 120), rng.randint(120, 160)))
+    draw = ImageDraw.Draw(image)
+    
+    # 窗口和标题栏
+    for _ in range(6):
+        x0, y0 = rng.randint(0, width // 2), rng.randint(0, height // 2)
+        x1, y1 = x0 + rng.randint(width // 5, width // 2), y0 + rng.randint(height // 5, height // 2)
+        draw.rectangle((x0, y0, x1, y1), fill=(rng.randint(220, 255),) * 3, outline=(90, 90, 90))
+        draw.rectangle((x0, y0, x1, y0 + 24), fill=(rng.randint(0, 80), rng.randint(60, 140), 200))
+        # 文字行用随机长度的短横线代替
+        for y in range(y0 + 34, y1 - 12, 18):
+            x = x0 + 8
+            while x < x1 - 40:
+                word = rng.randint(10, 60)
+                draw.rectangle((x, y, min(x + word, x1 - 8), y + 9), fill=(rng.randint(0, 60),) * 3)
+                x += word + 7
+    
+    # 照片类区域，压缩率明显低于界面部分
+    patch = Image.effect_noise((width // 4, height // 4), 48).convert("RGB")
+    image.paste(patch, (rng.randint(0, width - patch.width), rng.randint(0, height - patch.height)))
+    return image
+
+class SyntheticCaptureBackend:
+    """依次返回预先生成的合成截图，代替剪贴板或屏幕抓取"""
+    name = "synthetic"
+    uses_clipboard = False
+    
+    def __init__(self, images):
+        self.images = images
+        self.index = 0
+    
+    def grab(self):
+        image = self.images[self.index % len(self.images)]
+        self.index += 1
+        return image
+
+class EditingCaptureBackend:
+    """模拟同一操作员的连续截图：每次在上一张的基础上改动一小块区域（输入文字、弹出提示等）"""
+    name = "editing"
+    uses_clipboard = False
+    
+    def __init__(self, image, seed=0):
+        self.image = image
+        self.rng = random.Random(seed)
+    
+    def grab(self):
+        from PIL import ImageDraw
+        image = self.image.copy()
+        draw = ImageDraw.Draw(image)
+        width, height = image.size
+        x, y = self.rng.randint(0, width - 320), self.rng.randint(0, height - 120)
+        draw.rectangle((x, y, x + self.rng.randint(80, 320), y + self.rng.randint(20, 120)),
+                       fill=(self.rng.randint(200, 255),) * 3, outline=(90, 90, 90))
+        draw.rectangle((x + 8, y + 8, x + self.rng.randint(40, 72), y + 17), fill=(self.rng.randint(0, 60),) * 3)
+        self.image = image
+        return image
+
+def resource_usage():
+    """返回 (进程CPU时间秒, 已退出子进程CPU时间秒, 峰值常驻内存MB)，无法获取时后两项为None。
+    编码进程池的CPU时间在进程池关闭、子进程退出后才计入子进程时间"""
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # Linux下单位为KB，macOS下为字节
+        peak_mb = usage.ru_maxrss / 1024 / 1024 if sys.platform == "darwin" else usage.ru_maxrss / 1024
+        children_cpu = children.ru_utime + children.ru_stime
+    except ImportError:
+        peak_mb = children_cpu = None
+    return time.process_time(), children_cpu, peak_mb
+
+def run_discovery(server, logger):
+    """测试目录探测，返回 (耗时秒, 找到的目录)"""
+    uploader = FTPUploader(server.host, server.USER, server.PASSWORD, logger, port=server.port)
+    test_thread = uploader.test_connection()
+    test_thread.log_signal.disconnect()
+    test_thread.log_signal.connect(logger.log, Qt.DirectConnection)
+    start = time.monotonic()
+    test_thread.run()
+    return time.monotonic() - start, test_thread.working_directory
+
+def run_scenario(server, logger, size, count, profile="default", interval=0.0, upload_workers=2, rate_limit=None,
+                 encode_workers=0, edits=False, incremental=False, memory_budget=None, memory_policy="spill",
+                 engine="ftplib", concurrency=4, stream=False, blocksize=64 * 1024, timeout=300.0):
+    """按给定尺寸连续截图count次，等待全部上传完成后返回统计结果
+    engine为asyncio时只用一个上传线程，每次取出最多concurrency个截图同时上传；
+    stream时边编码边上传，STOR每次发送blocksize字节"""
+    metrics = PipelineMetrics()
+    ftp_engine = None
+    batch_max_items = 1
+    if engine == "asyncio":
+        from screenshot_ftp_async import AsyncFTPEngine, AsyncFTPUploader
+        ftp_engine = AsyncFTPEngine()
+        uploader = AsyncFTPUploader(ftp_engine, server.host, server.USER, server.PASSWORD, logger, metrics,
+                                    blocksize, server.port, concurrency=concurrency)
+        upload_workers, batch_max_items = 1, concurrency
+    else:
+        uploader = FTPUploader(server.host, server.USER, server.PASSWORD, logger, metrics, blocksize, server.port)
+    uploader.working_directory = "/" + server.directory + "/"
+    if rate_limit:
+        uploader.limiter = BandwidthLimiter(rate_limit, metrics=metrics)
+    if edits:
+        backend = EditingCaptureBackend(make_synthetic_image(size[0], size[1]))
+    else:
+        backend = SyntheticCaptureBackend([make_synthetic_image(size[0], size[1], seed) for seed in range(min(count, 4))])
+    encoder = ImageEncoder(profile, workers=encode_workers)
+    # 进程池在计时之前启动并预热，与正常运行时一致
+    encoder.start()
+    manager = ScreenshotManager(uploader, logger, encoder, backend)
+    if incremental:
+        from screenshot_ftp_delta import TileDeltaEncoder
+        manager.tile_delta = TileDeltaEncoder()
+    spool_dir = tempfile.mkdtemp(prefix="ftp-bench-spool-")
+    spool = UploadSpool(spool_dir, logger)
+    spill_dir = tempfile.mkdtemp(prefix="ftp-bench-spill-")
+    frame_budget = None
+    if memory_budget:
+        frame_budget = FrameBudget(memory_budget, logger, memory_policy, spill_dir, metrics)
+    pipeline = UploadPipeline(manager, uploader, spool, logger, max_pending=count, upload_workers=upload_workers,
+                              retry_base_delay=0.2, retry_max_delay=2.0, metrics=metrics, frame_budget=frame_budget,
+                              batch_max_items=batch_max_items, stream_upload=stream)
+    
+    succeeded = []
+    accepted = 0
+    pipeline.upload_finished.connect(lambda success, filename: success and succeeded.append(filename),
+                                     Qt.DirectConnection)
+    pipeline.start()
+    cpu_start, children_start, _ = resource_usage()
+    start = time.monotonic()
+    # 运行期间的最大线程数，包括本机模拟服务器每个连接的线程
+    peak_threads = threading.active_count()
+    try:
+        for _ in range(count):
+            key_time = time.monotonic()
+            image, error = manager.grab_image()
+            if image is None:
+                raise RuntimeError(error)
+            accepted += pipeline.submit(image, {"key_event": key_time, "clipboard_ready": key_time,
+                                                "grabbed": time.monotonic()})
+            if interval:
+                time.sleep(interval)
+        
+        deadline = start + timeout
+        # 超出内存预算被丢弃的截图不会上传
+        while len(succeeded) + metrics.frames_dropped < accepted and time.monotonic() < deadline:
+            peak_threads = max(peak_threads, threading.active_count())
+            time.sleep(0.01)
+        elapsed = time.monotonic() - start
+    finally:
+        pipeline.stop()
+        encoder.close()
+        uploader.close()
+        if ftp_engine:
+            ftp_engine.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    # 进程池已在上面关闭，编码进程的CPU时间（含进程启动）计入每张截图的CPU耗时
+    cpu_end, children_end, peak_rss = resource_usage()
+    cpu_ms = None
+    if children_start is not None:
+        cpu_ms = round((cpu_end - cpu_start + children_end - children_start) * 1000 / count, 1)
+    elif not encode_workers:
+        cpu_ms = round((cpu_end - cpu_start) * 1000 / count, 1)
+    
+    stages, counters = metrics.snapshot()
+    return {
+        "size": f"{size[0]}x{size[1]}",
+        "profile": profile,
+        "captures": count,
+        "uploaded": len(succeeded),
+        "failed_attempts": counters["uploads_failed"],
+        "seconds": round(elapsed, 3),
+        "captures_per_second": round(len(succeeded) / elapsed, 2) if elapsed else 0.0,
+        "throughput_kb": round(counters["bytes_sent"] / 1024 / elapsed, 1) if elapsed else 0.0,
+        "avg_file_kb": round(counters["bytes_sent"] / 1024 / max(1, counters["uploads_succeeded"]), 1),
+        "resumed_kb": round(counters["bytes_resumed"] / 1024, 1),
+        "dropped": count - accepted + counters["frames_dropped"],
+        "latency_p50_ms": round(stages["total"][2][0] * 1000, 1),
+        "latency_p95_ms": round(stages["total"][2][1] * 1000, 1),
+        "latency_p99_ms": round(stages["total"][2][2] * 1000, 1),
+        "preprocess_p50_ms": round(stages["preprocess"][2][0] * 1000, 1),
+        "encode_p50_ms": round(stages["encode"][2][0] * 1000, 1),
+        "transfer_p50_ms": round(stages["transfer"][2][0] * 1000, 1),
+        "pixels_saved_pct": round(100 * (1 - counters["pixels_out"] / counters["pixels_in"]), 1)
+        if counters["pixels_in"] else 0.0,
+        # 无法统计编码进程的CPU时间时为None，不参与基准对比
+        "cpu_ms_per_capture": cpu_ms,
+        "peak_threads": peak_threads,
+        "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None,
+    }
+
+def run_startup(count):
+    """每个启动场景在新的Python进程中执行count次，包括解释器启动，与用户启动程序时一致"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for name, code in STARTUP_SCENARIOS.items():
+        command = [sys.executable, "-c", code]
+        # 第一次运行生成字节码缓存，不计入统计
+        subprocess.run(command, cwd=directory, check=True)
+        samples = []
+        for _ in range(count):
+            start = time.monotonic()
+            subprocess.run(command, cwd=directory, check=True)
+            samples.append(time.monotonic() - start)
+        samples.sort()
+        results[name] = {
+            "runs": count,
+            "startup_p50_ms": round(samples[len(samples) // 2] * 1000, 1),
+            "startup_min_ms": round(samples[0] * 1000, 1),
+            "startup_max_ms": round(samples[-1] * 1000, 1),
+        }
+    return results
+
+def compare_baseline(results, baseline, tolerance):
+    """与基准对比，返回退化项列表 [(场景, 指标, 基准值, 当前值)]"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric, higher_is_better in BASELINE_METRICS.items():
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            if metric.endswith("_ms") and abs(new - old) < MIN_REGRESSION_MS:
+                continue
+            if higher_is_better and new < old * (1 - tolerance):
+                regressions.append((name, metric, old, new))
+            elif not higher_is_better and new > old * (1 + tolerance):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+def run_qimage_scenario(path, format_name, count, profile):
+    """在当前进程中测量QImage转换为PIL图像及编码的耗时和内存，path为合成截图的PNG文件"""
+    from PyQt5.QtGui import QImage
+    qimage = QImage(path).convertToFormat(getattr(QImage, f"Format_{format_name}"))
+    encoder = ImageEncoder(profile)
+    _, _, rss_before = resource_usage()
+    convert, encode = [], []
+    cpu_start = time.process_time()
+    for _ in range(count):
+        start = time.monotonic()
+        image = qimage_to_pil(qimage)
+        converted = time.monotonic()
+        encoder.encode(image, io.BytesIO())
+        convert.append(converted - start)
+        encode.append(time.monotonic() - converted)
+        del image
+    cpu = time.process_time() - cpu_start
+    _, _, peak_rss = resource_usage()
+    convert.sort()
+    encode.sort()
+    return {
+        "size": f"{qimage.width()}x{qimage.height()}",
+        "format": format_name,
+        "profile": profile,
+        "captures": count,
+        "frame_mb": round(qimage.sizeInBytes() / 1024 / 1024, 1),
+        "convert_p50_ms": round(convert[len(convert) // 2] * 1000, 2),
+        "encode_p50_ms": round(encode[len(encode) // 2] * 1000, 1),
+        "cpu_ms_per_capture": round(cpu * 1000 / count, 1),
+        "rss_before_mb": round(rss_before, 1) if rss_before is not None else None,
+        "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None,
+    }
+
+def run_qimage(sizes, count, profile):
+    """每种尺寸和QImage格式在新进程中测试，峰值内存互不影响"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    temp_dir = tempfile.mkdtemp(prefix="qimage-bench-")
+    results = {}
+    try:
+        for width, height in sizes:
+            path = os.path.join(temp_dir, f"{width}x{height}.png")
+            make_synthetic_image(width, height).save(path, compress_level=1)
+            for format_name in QIMAGE_FORMATS:
+                code = (f"import json, screenshot_ftp_bench as bench; "
+                        f"print(json.dumps(bench.run_qimage_scenario({path!r}, {format_name!r}, {count}, {profile!r})))")
+                output = subprocess.run([sys.executable, "-c", code], cwd=directory, check=True,
+                                        capture_output=True, text=True).stdout
+                results[f"qimage-{format_name}-{profile}-{width}x{height}"] = json.loads(output.splitlines()[-1])
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+def print_results(results):
+    columns = ("captures_per_second", "throughput_kb", "avg_file_kb", "latency_p50_ms", "latency_p95_ms",
+               "encode_p50_ms", "cpu_ms_per_capture", "peak_rss_mb")
+    print(f"{'场景':<24}" + "".join(f"{column:>20}" for column in columns))
+    for name, result in results.items():
+        print(f"{name:<26}" + "".join(f"{str(result.get(column)):>20}" for column in columns))
+
+def run_bench(args):
+    """执行性能测试，返回进程退出码"""
+    logger = Logger()
+    if args.verbose:
+        logger.log_signal.connect(print_log, Qt.DirectConnection)
+    
+    if args.startup:
+        results = run_startup(args.count)
+        for name, result in results.items():
+            print(f"{name:<16}p50 {result['startup_p50_ms']:>7} ms  "
+                  f"min {result['startup_min_ms']:>7} ms  max {result['startup_max_ms']:>7} ms")
+        return save_results(results, args)
+    
+    sizes = DEFAULT_SIZES
+    if args.sizes:
+        sizes = [tuple(int(v) for v in size.split("x")) for size in args.sizes.split(",")]
+    
+    if args.qimage:
+        results = run_qimage(sizes, args.count, args.profile)
+        columns = ("frame_mb", "convert_p50_ms", "encode_p50_ms", "cpu_ms_per_capture", "rss_before_mb", "peak_rss_mb")
+        print(f"{'场景':<30}" + "".join(f"{column:>20}" for column in columns))
+        for name, result in results.items():
+            print(f"{name:<32}" + "".join(f"{str(result[column]):>20}" for column in columns))
+        return save_results(results, args)
+    
+    server = LocalFTPServer(latency=args.latency / 1000, bandwidth=args.bandwidth * 1024 if args.bandwidth else None,
+                            failure_rate=args.failure_rate, drop_rate=args.drop_rate).start()
+    results = {}
+    try:
+        # 注入的失败只用于上传场景，目录探测不重试
+        server.failure_rate = server.drop_rate = 0.0
+        seconds, directory = run_discovery(server, logger)
+        server.failure_rate, server.drop_rate = args.failure_rate, args.drop_rate
+        print(f"目录探测: {seconds * 1000:.0f} ms, 找到 {directory}")
+        if directory is None:
+            return 1
+        results["discovery"] = {"latency_p50_ms": round(seconds * 1000, 1)}
+        
+        for size in sizes:
+            name = f"{args.profile}-{size[0]}x{size[1]}" + ("-edits" if args.edits else "") + \
+                   ("-incremental" if args.incremental else "") + \
+                   (f"-{args.memory_policy}{args.memory_budget:g}mb" if args.memory_budget else "") + \
+                   (f"-asyncio{args.concurrency}" if args.engine == "asyncio" else "") + \
+                   ("-stream" if args.stream else "")
+            results[name] = run_scenario(server, logger, size, args.count, args.profile, args.interval,
+                                         args.upload_workers, args.rate_limit * 1024 if args.rate_limit else None,
+                                         args.encode_workers, args.edits, args.incremental,
+                                         args.memory_budget * 1024 * 1024 if args.memory_budget else None,
+                                         args.memory_policy, args.engine, args.concurrency, args.stream,
+                                         int(args.blocksize * 1024))
+    finally:
+        server.close()
+    
+    print_results({name: result for name, result in results.items() if name != "discovery"})
+    return save_results(results, args)
+
+def save_results(results, args):
+    """写出结果并与基准对比，返回进程退出码"""
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"基准结果已保存: {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_baseline(results, baseline, args.tolerance)
+        for name, metric, old, new in regressions:
+            print(f"性能退化: {name} {metric} {old} -> {new}")
+        if regressions:
+            return 1
+        print(f"与基准相比没有超过 {args.tolerance:.0%} 的退化")
+    return 0
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+截图FTP上传工具 - 增量截图
+连续截图时大部分内容（桌面、程序界面）不变：按图块与上一张截图比较，定期上传完整的关键帧，
+其间只上传变化的图块（拼成一张PNG）和清单，打包为 .delta.zip；rebuild 命令在本地还原完整截图。
+需要numpy，只在启用增量上传或还原时导入。
+"""
+import os
+import io
+import json
+import zipfile
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from screenshot_ftp_nanAn_kylin import ImageEncoder
+
+DELTA_SUFFIX = ".delta.zip"
+MANIFEST_NAME = "manifest.json"
+TILES_NAME = "tiles.png"
+
+def frame_array(image):
+    """转换为 (高, 宽, 通道) 的数组"""
+    if image.mode not in ("RGB", "RGBA", "L"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    array = np.asarray(image)
+    if array.ndim == 2:
+        array = array[:, :, np.newaxis]
+    return image.mode, array
+
+def pad_to_tiles(array, tile):
+    """补零到图块大小的整数倍"""
+    height, width = array.shape[:2]
+    padded_height, padded_width = -(-height // tile) * tile, -(-width // tile) * tile
+    if (padded_height, padded_width) == (height, width):
+        return array
+    padded = np.zeros((padded_height, padded_width, array.shape[2]), np.uint8)
+    padded[:height, :width] = array
+    return padded
+
+def split_tiles(array, tile):
+    """(高, 宽, 通道) -> (行, 列, 图块高, 图块宽, 通道)，不复制数据"""
+    height, width, channels = array.shape
+    return array.reshape(height // tile, tile, width // tile, tile, channels).swapaxes(1, 2)
+
+def to_image(array, mode):
+    return Image.fromarray(array[:, :, 0] if mode == "L" else array, mode)
+
+class TileDeltaEncoder:
+    """增量编码：与上一张截图逐图块比较，尺寸变化、变化图块过多或距上一关键帧已有
+    keyframe_interval张时上传完整关键帧，否则上传只含变化图块的增量文件"""
+    def __init__(self, tile=64, keyframe_interval=10, max_changed_ratio=0.5, compress_level=6):
+        self.tile = tile
+        self.keyframe_interval = keyframe_interval
+        self.max_changed_ratio = max_changed_ratio
+        self.compress_level = compress_level
+        # 增量按原始像素比较，编码方案有损（JPEG、有损WebP、调色板）时关键帧改用PNG，否则无法精确还原
+        self.lossless_encoder = ImageEncoder("default", compress_level=compress_level)
+        # 上一张截图（已补零）及其上传文件名
+        self.previous = None
+        self.previous_mode = None
+        self.previous_name = None
+        self.keyframe_name = None
+        self.since_keyframe = 0
+    
+    def encode(self, image, manager, filename=None):
+        """编码一张截图，返回 (文件名, 字节流)；关键帧使用manager的编码方案，该方案有损时使用PNG"""
+        mode, array = frame_array(image)
+        height, width = array.shape[:2]
+        padded = pad_to_tiles(array, self.tile)
+        
+        changed = None
+        if (filename is None and self.previous is not None and self.previous.shape == padded.shape
+                and self.previous_mode == mode and self.since_keyframe < self.keyframe_interval):
+            # 逐图块比较是否有任一像素不同
+            changed = (split_tiles(padded, self.tile) != split_tiles(self.previous, self.tile)).any(axis=(2, 3, 4))
+            if changed.mean() > self.max_changed_ratio:
+                changed = None
+        
+        if changed is None:
+            encoder = manager.encoder if manager.encoder.lossless else self.lossless_encoder
+            filename = filename or manager.make_filename(encoder.extension)
+            data = io.BytesIO()
+            encoder.encode(image, data)
+            manager.logger.info(f"上传关键帧: {filename}")
+            self.keyframe_name = filename
+            self.since_keyframe = 0
+        else:
+            filename = manager.make_filename(DELTA_SUFFIX[1:])
+            data = self.encode_delta(padded, changed, mode, (width, height))
+            manager.logger.info(f"上传增量截图: {filename}（{int(changed.sum())}/{changed.size} 个图块有变化）")
+            self.since_keyframe += 1
+        
+        self.previous, self.previous_mode, self.previous_name = padded, mode, filename
+        data.seek(0)
+        return filename, data
+    
+    def encode_delta(self, padded, changed, mode, size):
+        """变化的图块按顺序拼成一张接近正方形的PNG，与清单一起打包"""
+        rows, columns = np.nonzero(changed)
+        tiles = split_tiles(padded, self.tile)[changed]
+        count = len(tiles)
+        atlas_columns = max(1, int(np.ceil(np.sqrt(count))))
+        atlas_rows = max(1, -(-count // atlas_columns))
+        grid = np.zeros((atlas_rows * atlas_columns,) + tiles.shape[1:], np.uint8)
+        grid[:count] = tiles
+        atlas = grid.reshape(atlas_rows, atlas_columns, *tiles.shape[1:]).swapaxes(1, 2).reshape(
+            atlas_rows * self.tile, atlas_columns * self.tile, tiles.shape[3])
+        
+        atlas_data = io.BytesIO()
+        to_image(atlas, mode).save(atlas_data, format="PNG", compress_level=self.compress_level)
+        manifest = {
+            "version": 1,
+            "previous": self.previous_name,
+            "keyframe": self.keyframe_name,
+            "size": list(size),
+            "mode": mode,
+            "tile": self.tile,
+            "columns": atlas_columns,
+            # 变化图块在原图中的 [列, 行]，与拼图中的顺序一致
+            "tiles": [[int(column), int(row)] for row, column in zip(rows, columns)],
+        }
+        data = io.BytesIO()
+        # PNG已经压缩过，zip中只存储不再压缩
+        with zipfile.ZipFile(data, "w", zipfile.ZIP_STORED) as zf:
+            zf.writestr(MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False))
+            zf.writestr(TILES_NAME, atlas_data.getvalue())
+        return data
+
+def read_delta(path):
+    """读取增量文件，返回 (清单, 拼图数组)"""
+    with zipfile.ZipFile(path) as zf:
+        manifest = json.loads(zf.read(MANIFEST_NAME).decode("utf-8"))
+        with Image.open(io.BytesIO(zf.read(TILES_NAME))) as atlas:
+            _, atlas_array = frame_array(atlas.convert(manifest["mode"]))
+    return manifest, atlas_array
+
+def apply_delta(base, manifest, atlas):
+    """将变化的图块写入上一张截图（已补零的数组），返回新数组"""
+    tile = manifest["tile"]
+    frame = base.copy()
+    for index, (column, row) in enumerate(manifest["tiles"]):
+        atlas_row, atlas_column = divmod(index, manifest["columns"])
+        frame[row * tile:(row + 1) * tile, column * tile:(column + 1) * tile] = \
+            atlas[atlas_row * tile:(atlas_row + 1) * tile, atlas_column * tile:(atlas_column + 1) * tile]
+    return frame
+
+def index_files(directory, exclude=None):
+    """递归列出目录中的文件: 文件名 -> 路径；上传时按日期分子目录的截图也能找到，前一张可以在前一天的目录中"""
+    files = {}
+    for root, dirs, names in os.walk(directory):
+        if exclude:
+            dirs[:] = [name for name in dirs if os.path.abspath(os.path.join(root, name)) != os.path.abspath(exclude)]
+        for name in names:
+            files[name] = os.path.join(root, name)
+    return files
+
+def rebuild_directory(directory, output, logger, cache_size=4):
+    """用目录（含子目录）中的关键帧和增量文件还原每张增量截图为PNG，按原来的子目录输出，返回 (成功数, 失败数)"""
+    os.makedirs(output, exist_ok=True)
+    files = index_files(directory, exclude=output)
+    deltas = sorted(name for name in files if name.endswith(DELTA_SUFFIX))
+    # 最近还原的截图: 文件名 -> 已补零的数组，按文件名顺序处理时上一张通常已在其中
+    frames = OrderedDict()
+    rebuilt = failed = 0
+    
+    for name in deltas:
+        try:
+            # 沿 previous 向前找到已还原的截图或关键帧，再依次应用增量
+            chain = []
+            current = name
+            while current not in frames and current.endswith(DELTA_SUFFIX):
+                manifest, atlas = read_delta(files[current])
+                chain.append((current, manifest, atlas))
+                current = manifest["previous"]
+            if current in frames:
+                frame = frames[current]
+            else:
+                tile, mode = chain[-1][1]["tile"], chain[-1][1]["mode"]
+                with Image.open(files[current]) as keyframe:
+                    frame = pad_to_tiles(frame_array(keyframe.convert(mode))[1], tile)
+            
+            for current, manifest, atlas in reversed(chain):
+                frame = apply_delta(frame, manifest, atlas)
+                frames[current] = frame
+                while len(frames) > cache_size:
+                    frames.popitem(last=False)
+            
+            width, height = manifest["size"]
+            target_directory = os.path.join(output, os.path.relpath(os.path.dirname(files[name]), directory))
+            os.makedirs(target_directory, exist_ok=True)
+            target = os.path.normpath(os.path.join(target_directory, name[:-len(DELTA_SUFFIX)] + ".png"))
+            to_image(np.ascontiguousarray(frame[:height, :width]), manifest["mode"]).save(target, format="PNG")
+            logger.success(f"已还原: {target}")
+            rebuilt += 1
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            # 缺少前一张截图或关键帧时无法还原
+            logger.error(f"无法还原 {name}: {e}")
+            failed += 1
+    return rebuilt, failed
+
+def run_rebuild(args):
+    """执行还原命令，返回进程退出码"""
+    from PyQt5.QtCore import Qt
+    from screenshot_ftp_nanAn_kylin import Logger, print_log
+    logger = Logger()
+    logger.log_signal.connect(print_log, Qt.DirectConnection)
+    output = args.output or os.path.join(args.directory, "rebuilt")
+    rebuilt, failed = rebuild_directory(args.directory, output, logger)
+    print(f"还原 {rebuilt} 张截图，失败 {failed} 张，输出目录: {output}")
+    return 1 if failed else 0
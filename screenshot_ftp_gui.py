@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+截图FTP上传工具 - 界面部分
+主窗口、日志窗口和后台模式的托盘图标，只在显示界面时导入
+"""
+import sys
+import os
+import time
+from collections import deque
+from datetime import datetime
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QPushButton, QVBoxLayout, 
+                           QWidget, QLabel, QSystemTrayIcon, QMenu, QAction, 
+                           QMessageBox, QPlainTextEdit, QHBoxLayout, QSplitter,
+                           QStyle)
+from PyQt5.QtCore import Qt, QObject, QTimer
+from PyQt5.QtGui import QIcon, QTextCursor, QTextCharFormat, QColor, QFont
+from screenshot_ftp_nanAn_kylin import (IS_LINUX, Logger, FileLogSink, UploaderService, get_app_data_dir,
+                                        print_log, PROCESS_START)
+
+def create_logger():
+    """创建日志组件，同时写入日志文件"""
+    return Logger(FileLogSink(os.path.join(get_app_data_dir("logs"), "screenshot_ftp.log")))
+
+def tray_icon_image(style):
+    """托盘图标"""
+    if IS_LINUX:
+        # 在Linux上使用QIcon.fromTheme
+        icon = QIcon.fromTheme("accessories-screenshot", QIcon.fromTheme("image"))
+        if icon.isNull():
+            icon = style.standardIcon(QStyle.SP_ComputerIcon)
+        return icon
+    # 在Windows上使用标准图标
+    return style.standardIcon(QStyle.SP_MessageBoxInformation)
+
+class LogWidget(QPlainTextEdit):
+    """日志窗口，只保留最近的若干条日志，新日志按定时器批量追加"""
+    # 级别 -> (标签, 颜色, 是否加粗)
+    LEVEL_STYLES = {
+        "error": ("[错误]", "#ff0000", True),
+        "warning": ("[警告]", "#ff9900", False),
+        "success": ("[成功]", "#009900", False),
+        "info": ("[信息]", "#0066cc", False),
+    }
+    
+    def __init__(self, parent=None, max_entries=2000, flush_interval=100):
+        super().__init__(parent)
+        self.setReadOnly(True)
+        self.setLineWrapMode(QPlainTextEdit.WidgetWidth)
+        self.setMaximumBlockCount(max_entries)
+        self.setStyleSheet("""
+            QPlainTextEdit {
+                background-color: #f5f5f5;
+                color: #333333;
+                font-family: Monospace;
+                font-size: 9pt;
+                border: 1px solid #cccccc;
+            }
+        """)
+        
+        # 等待显示的日志；已显示的日志由文档的最大行数限制，两者长度固定，内存不随运行时间增长
+        self.pending = deque(maxlen=max_entries)
+        
+        self.timestamp_format = QTextCharFormat()
+        self.timestamp_format.setForeground(QColor("#888888"))
+        self.message_format = QTextCharFormat()
+        self.level_formats = {}
+        for level, (_, color, bold) in self.LEVEL_STYLES.items():
+            level_format = QTextCharFormat()
+            level_format.setForeground(QColor(color))
+            if bold:
+                level_format.setFontWeight(QFont.Bold)
+            self.level_formats[level] = level_format
+        
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(flush_interval)
+        self.flush_timer.timeout.connect(self.flush)
+    
+    def append_log(self, message, level="info"):
+        if level not in self.LEVEL_STYLES:
+            level = "info"
+        entry = (datetime.now().strftime("%H:%M:%S"), level, message)
+        self.pending.append(entry)
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+    
+    def flush(self):
+        """将等待中的日志一次性追加到窗口"""
+        if not self.pending:
+            return
+        
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.beginEditBlock()
+        while self.pending:
+            timestamp, level, message = self.pending.popleft()
+            if not self.document().isEmpty():
+                cursor.insertBlock()
+            cursor.insertText(f"[{timestamp}] ", self.timestamp_format)
+            cursor.insertText(self.LEVEL_STYLES[level][0], self.level_formats[level])
+            cursor.insertText(f" {message}", self.message_format)
+        cursor.endEditBlock()
+        
+        self.setTextCursor(cursor)
+        self.ensureCursorVisible()
+    
+    def clear(self):
+        self.pending.clear()
+        super().clear()
+
+class MainWindow(QMainWindow):
+    def __init__(self, config):
+        super().__init__()
+        
+        self.logger = create_logger()
+        self.ftp_host = config["ftp_host"]
+        
+        # 截图上传服务
+        self.service = UploaderService(config, self.logger)
+        self.metrics = self.service.metrics
+        self.ftp_uploader = self.service.ftp_uploader
+        self.service.capture_finished.connect(self.on_upload_finished)
+        self.service.monitoring_changed.connect(self.on_monitoring_changed)
+        self.service.directory_changed.connect(self.update_directory_info)
+        self.service.test_finished.connect(self.on_test_finished)
+        # 关闭窗口等任何方式退出时都停止服务，写出剩余的日志并等待上传线程
+        QApplication.instance().aboutToQuit.connect(self.service.close)
+        
+        # 设置UI
+        self.setWindowTitle("截图FTP上传工具 - 南安专用版")
+        self.setGeometry(300, 300, 600, 600)
+        
+        # 创建分割器
+        splitter = QSplitter(Qt.Vertical)
+        self.setCentralWidget(splitter)
+        
+        # 上半部分控制面板
+        control_widget = QWidget()
+        control_layout = QVBoxLayout(control_widget)
+        
+        # 添加标签
+        info_label = QLabel("按下Print Screen键自动上传截图到FTP服务器")
+        info_label.setStyleSheet("font-weight: bold; font-size: 12pt;")
+        control_layout.addWidget(info_label)
+        
+        # FTP配置信息标签
+        self.ftp_info_label = QLabel(f"FTP服务器: {self.ftp_host}\n目录: /南安/ (将自动查找正确编码的路径)")
+        control_layout.addWidget(self.ftp_info_label)
+        
+        # 状态标签
+        self.status_label = QLabel("状态: 未运行")
+        self.status_label.setStyleSheet("font-weight: bold;")
+        control_layout.addWidget(self.status_label)
+        
+        # 按钮区域 - 使用水平布局
+        button_layout = QHBoxLayout()
+        
+        # 添加测试连接按钮
+        self.test_button = QPushButton("测试FTP连接")
+        self.test_button.setMinimumHeight(30)
+        self.test_button.clicked.connect(self.test_ftp_connection)
+        button_layout.addWidget(self.test_button)
+        
+        # 添加开始按钮
+        self.start_button = QPushButton("开始监听")
+        self.start_button.setMinimumHeight(30)
+        self.start_button.clicked.connect(self.start_monitoring)
+        button_layout.addWidget(self.start_button)
+        
+        # 添加停止按钮
+        self.stop_button = QPushButton("停止监听")
+        self.stop_button.setMinimumHeight(30)
+        self.stop_button.clicked.connect(self.stop_monitoring)
+        self.stop_button.setEnabled(False)
+        button_layout.addWidget(self.stop_button)
+        
+        # 添加清除日志按钮
+        self.clear_log_button = QPushButton("清除日志")
+        self.clear_log_button.setMinimumHeight(30)
+        self.clear_log_button.clicked.connect(self.clear_log)
+        button_layout.addWidget(self.clear_log_button)
+        
+        control_layout.addLayout(button_layout)
+        
+        # 统计面板
+        self.stats_label = QLabel()
+        self.stats_label.setStyleSheet("font-family: Monospace; font-size: 9pt;")
+        self.stats_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        control_layout.addWidget(self.stats_label)
+        self.stats_timer = QTimer(self)
+        self.stats_timer.timeout.connect(self.update_stats)
+        self.stats_timer.start(2000)
+        self.update_stats()
+        
+        # 下半部分日志窗口
+        self.log_widget = LogWidget()
+        self.logger.log_signal.connect(self.log_widget.append_log)
+        
+        # 添加到分割器
+        splitter.addWidget(control_widget)
+        splitter.addWidget(self.log_widget)
+        splitter.setSizes([250, 350])  # 设置初始大小比例
+        
+        # 创建系统托盘图标
+        self.create_tray_icon()
+        
+        # 启动服务，日志窗口连接后再输出初始日志
+        if not self.service.start():
+            self.logger.info("请点击\"测试FTP连接\"按钮测试连接")
+    
+    @property
+    def is_monitoring(self):
+        return self.service.is_monitoring
+    
+    def update_directory_info(self):
+        """更新目录信息显示"""
+        if self.ftp_uploader.working_directory:
+            self.ftp_info_label.setText(f"FTP服务器: {self.ftp_host}\n目录: {self.ftp_uploader.working_directory} (已验证可上传)")
+        else:
+            self.ftp_info_label.setText(f"FTP服务器: {self.ftp_host}\n目录: /南安/ (将自动查找正确编码的路径)")
+            self.logger.warning("请点击\"测试FTP连接\"按钮重新查找上传目录")
+        
+    def update_stats(self):
+        """刷新统计面板，窗口隐藏时跳过"""
+        if self.isVisible() or not self.stats_label.text():
+            self.stats_label.setText(self.metrics.format_summary())
+    
+    def clear_log(self):
+        """清除日志窗口内容"""
+        self.log_widget.clear()
+        self.logger.info("日志已清除")
+    
+    def test_ftp_connection(self):
+        """测试FTP连接，使用线程避免UI阻塞"""
+        self.test_button.setEnabled(False)
+        self.test_button.setText("正在测试连接...")
+        self.service.test_ftp_connection()
+    
+    def on_test_finished(self, success, message):
+        """当测试线程完成时处理结果"""
+        # 更新UI状态
+        self.test_button.setText("测试FTP连接")
+        self.test_button.setEnabled(True)
+        
+        # 显示结果
+        if success:
+            QMessageBox.information(self, "连接测试", message)
+        else:
+            QMessageBox.critical(self, "连接测试", message)
+    
+    def create_tray_icon(self):
+        # 创建托盘图标菜单
+        tray_menu = QMenu()
+        show_action = QAction("显示", self)
+        show_action.triggered.connect(self.show)
+        tray_menu.addAction(show_action)
+        
+        quit_action = QAction("退出", self)
+        quit_action.triggered.connect(self.close_application)
+        tray_menu.addAction(quit_action)
+        
+        # 创建托盘图标
+        self.tray_icon = QSystemTrayIcon(self)
+        self.tray_icon.setToolTip("截图FTP上传工具")
+        self.tray_icon.setContextMenu(tray_menu)
+        
+        # 设置图标并显示
+        self.tray_icon.setIcon(tray_icon_image(self.style()))
+        self.tray_icon.show()
+    
+    def start_monitoring(self):
+        # 检查是否已找到工作目录
+        if not self.service.start_monitoring():
+            QMessageBox.warning(self, "缺少工作目录", "请先点击\"测试FTP连接\"按钮，确认可用的上传目录。")
+            return
+        
+        # 最小化到托盘
+        self.hide()
+        self.tray_icon.showMessage("截图上传工具", "程序正在后台运行，按Print Screen键上传截图", QSystemTrayIcon.Information, 2000)
+    
+    def stop_monitoring(self):
+        self.service.stop_monitoring()
+    
+    def on_monitoring_changed(self, monitoring):
+        if monitoring:
+            self.status_label.setText("状态: 正在监听Print Screen键")
+            self.status_label.setStyleSheet("font-weight: bold; color: green;")
+        else:
+            self.status_label.setText("状态: 未运行")
+            self.status_label.setStyleSheet("font-weight: bold;")
+        self.start_button.setEnabled(not monitoring)
+        self.stop_button.setEnabled(monitoring)
+        self.test_button.setEnabled(not monitoring)
+    
+    def on_upload_finished(self, success, filename):
+        if success:
+            self.tray_icon.showMessage("截图已上传", f"截图已成功上传到FTP: {filename}", QSystemTrayIcon.Information, 2000)
+        else:
+            self.tray_icon.showMessage("上传失败", f"截图上传失败: {filename}", QSystemTrayIcon.Warning, 2000)
+    
+    def closeEvent(self, event):
+        # 拦截关闭事件，最小化到托盘而不是关闭
+        if self.is_monitoring:
+            event.ignore()
+            self.hide()
+            self.tray_icon.showMessage("截图上传工具", "程序已最小化到系统托盘", QSystemTrayIcon.Information, 2000)
+        else:
+            event.accept()
+    
+    def close_application(self):
+        # 实际关闭应用程序
+        self.logger.info("正在关闭程序...")
+        self.service.close()
+        QApplication.quit()
+
+class DaemonTray(QObject):
+    """后台模式：不创建主窗口，只显示托盘图标，启动后自动开始监听"""
+    # 探测上传目录失败后的重试间隔（毫秒）
+    RETRY_INTERVAL = 60000
+    
+    def __init__(self, config):
+        super().__init__()
+        self.logger = create_logger()
+        # 后台模式没有日志窗口，日志同时输出到标准错误
+        self.logger.log_signal.connect(print_log)
+        
+        self.service = UploaderService(config, self.logger)
+        self.service.capture_finished.connect(self.on_upload_finished)
+        self.service.directory_changed.connect(self.on_directory_changed)
+        self.service.test_finished.connect(self.on_test_finished)
+        QApplication.instance().aboutToQuit.connect(self.service.close)
+        
+        # 创建托盘图标菜单
+        self.tray_menu = QMenu()
+        quit_action = QAction("退出", self.tray_menu)
+        quit_action.triggered.connect(self.close_application)
+        self.tray_menu.addAction(quit_action)
+        
+        self.tray_icon = QSystemTrayIcon(tray_icon_image(QApplication.style()))
+        self.tray_icon.setToolTip("截图FTP上传工具")
+        self.tray_icon.setContextMenu(self.tray_menu)
+        self.tray_icon.show()
+        
+        self.first_listen = True
+        if self.service.start():
+            self.start_monitoring()
+        else:
+            self.service.test_ftp_connection()
+    
+    def on_directory_changed(self):
+        # 缓存的目录失效后重新探测
+        if not self.service.ftp_uploader.working_directory:
+            self.service.test_ftp_connection()
+    
+    def start_monitoring(self):
+        if self.service.start_monitoring() and self.first_listen:
+            self.first_listen = False
+            self.logger.info(f"从启动到开始监听耗时 {(time.monotonic() - PROCESS_START) * 1000:.0f} ms")
+    
+    def on_test_finished(self, success, message):
+        if success:
+            self.start_monitoring()
+            return
+        self.logger.error(message)
+        self.logger.warning(f"{self.RETRY_INTERVAL // 1000}秒后重新查找上传目录")
+        QTimer.singleShot(self.RETRY_INTERVAL, self.service.test_ftp_connection)
+    
+    def on_upload_finished(self, success, filename):
+        if success:
+            self.tray_icon.showMessage("截图已上传", f"截图已成功上传到FTP: {filename}", QSystemTrayIcon.Information, 2000)
+        else:
+            self.tray_icon.showMessage("上传失败", f"截图上传失败: {filename}", QSystemTrayIcon.Warning, 2000)
+    
+    def close_application(self):
+        self.logger.info("正在关闭程序...")
+        self.service.close()
+        self.tray_icon.hide()
+        QApplication.quit()
+
+def create_application():
+    app = QApplication(sys.argv)
+    
+    # 设置应用程序样式
+    app.setStyle('Fusion')
+    return app
+
+def run_gui(config):
+    """显示主窗口"""
+    app = create_application()
+    window = MainWindow(config)
+    window.show()
+    return app.exec_()
+
+def run_daemon(config):
+    """后台模式，没有主窗口，通过托盘菜单退出"""
+    app = create_application()
+    app.setQuitOnLastWindowClosed(False)
+    daemon = DaemonTray(config)
+    return app.exec_()
@@ -6,19 +6,33 @@
 import sys
 import os
 import time
+
+# 进程启动时间（在导入Qt之前记录），用于统计冷启动到开始监听的耗时
+PROCESS_START = time.monotonic()
+
 import threading
+import queue
+import json
+import random
+import hashlib
+import gzip
+import zlib
+import mmap
+import struct
+import shutil
+import socket
+import posixpath
+import logging
+import logging.handlers
+import argparse
+import contextlib
 import warnings
-from datetime import datetime
-from ftplib import FTP, error_perm
-import pyperclip
-from PyQt5.QtWidgets import (QApplication, QMainWindow, QPushButton, QVBoxLayout, 
-                           QWidget, QLabel, QSystemTrayIcon, QMenu, QAction, 
-                           QMessageBox, QTextEdit, QHBoxLayout, QSplitter,
-                           QStyle)
-from PyQt5.QtCore import Qt, QObject, pyqtSignal, QSize, QThread
-from PyQt5.QtGui import QIcon, QTextCursor, QPixmap
-from pynput import keyboard
-from PIL import ImageGrab, Image
+from collections import deque, OrderedDict
+from datetime import datetime, date
+from ftplib import FTP, error_perm, error_temp
+# 只在模块级导入QtCore，QtWidgets/QtGui、PIL、pynput 在用到时才导入，
+# 命令行上传和后台模式不必加载整个界面库
+from PyQt5.QtCore import Qt, QObject, pyqtSignal, QThread, QTimer, QRect
 import io
 
 # 忽略警告
@@ -27,23 +41,498 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 # Linux 系统兼容性处理
 IS_LINUX = sys.platform.startswith('linux')
 
+APP_NAME = "screenshot-ftp-uploader"
+
+def get_app_data_dir(*parts):
+    """返回程序数据目录（不存在时自动创建）"""
+    if IS_LINUX:
+        base = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+    else:
+        base = os.environ.get("APPDATA") or os.path.expanduser("~")
+    path = os.path.join(base, APP_NAME, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def get_app_config_dir():
+    """返回程序配置目录（不存在时自动创建）"""
+    if IS_LINUX:
+        base = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    else:
+        base = os.environ.get("APPDATA") or os.path.expanduser("~")
+    path = os.path.join(base, APP_NAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def write_file_atomic(path, data):
+    """先写临时文件再替换，保证程序崩溃时不会留下半个文件"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# 已验证的FTP上传目录缓存，按 用户@主机 保存
+FTP_CACHE_FILE = "ftp_cache.json"
+
+def load_ftp_cache(host, user):
+    """读取缓存的上传目录，返回 {"working_directory", "encoding", "verified_at"} 或None"""
+    try:
+        with open(os.path.join(get_app_config_dir(), FTP_CACHE_FILE), "r", encoding="utf-8") as f:
+            return json.load(f).get(f"{user}@{host}")
+    except Exception:
+        return None
+
+def save_ftp_cache(host, user, working_directory, encoding):
+    """保存验证通过的上传目录，working_directory为None时删除缓存"""
+    path = os.path.join(get_app_config_dir(), FTP_CACHE_FILE)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except Exception:
+        cache = {}
+    
+    key = f"{user}@{host}"
+    if working_directory is None:
+        cache.pop(key, None)
+    else:
+        cache[key] = {"working_directory": working_directory, "encoding": encoding, "verified_at": time.time()}
+    write_file_atomic(path, json.dumps(cache, ensure_ascii=False, indent=2).encode("utf-8"))
+
+# 默认配置，可在配置目录下的 config.json 中覆盖其中任意一项
+CONFIG_FILE = "config.json"
+DEFAULT_CONFIG = {
+    # FTP配置
+    "ftp_host": "44.112.2.110",
+    "ftp_port": 21,
+    "ftp_user": "msk350500",
+    "ftp_password": "qzxz@334",
+    # 按下截图键后等待剪贴板出现新图像的最长时间（秒）
+    "clipboard_timeout": 10.0,
+    # 与最近截图内容相同时的处理方式: skip/pointer/upload
+    "duplicate_policy": "skip",
+    # 截图方式: clipboard 读取系统截图工具放入剪贴板的图像, screen 直接抓取屏幕
+    "capture_backend": "clipboard",
+    # 直接抓取的区域: all/primary/screen:N/x,y,w,h
+    "capture_region": "all",
+    # 流式上传（边编码边上传）及STOR每次发送的块大小
+    "stream_upload": False,
+    "upload_blocksize": 64 * 1024,
+    # 上传方式: ftplib 每个上传线程一个会话依次上传, asyncio 在一个事件循环线程中通过最多
+    # upload_concurrency个会话同时上传一批截图
+    "upload_engine": "ftplib",
+    "upload_concurrency": 4,
+    # 图像编码方案: default/fast/small/palette/webp/jpeg/review
+    "encode_profile": "default",
+    # 增量上传（需要numpy）: 与上一张截图按incremental_tile像素的图块比较，只上传变化的图块，
+    # 每keyframe_interval张上传一次完整截图；用 rebuild 命令在本地还原
+    "incremental": False,
+    "incremental_tile": 64,
+    "keyframe_interval": 10,
+    # 等待编码的截图数上限，以及排队截图占用内存的预算（MB，为None时不限制）；
+    # 超出预算时的处理方式: spill 写入本地临时目录, drop_oldest 丢弃最早的截图,
+    # coalesce 不论是否超出预算都只保留最新的截图, drop_newest 丢弃新截图
+    "max_pending": 16,
+    "memory_budget_mb": 256,
+    "memory_policy": "spill",
+    # PNG多进程编码的进程数，0表示在编码线程中单独编码；大截图按水平条带分给各进程并行压缩
+    "encode_workers": 0,
+    # 编码前预处理，覆盖编码方案中的设置，例如:
+    # {"max_edge": 1920, "crop": "window", "strip_alpha": true}
+    # crop 为 window 时只保留活动窗口, changed 时只保留与上一张截图相比有变化的区域
+    "preprocess": None,
+    # 批量上传: 已在排队的截图（最多batch_max_items个/batch_max_bytes字节）在同一会话中依次上传，
+    # batch_window为取到第一个截图后继续等待后续截图的秒数（0表示不等待，不增加上传延迟）
+    "batch_window": 0.0,
+    "batch_max_items": 8,
+    "batch_max_bytes": 16 * 1024 * 1024,
+    # 批量上传时打包为一个带清单的zip文件
+    "batch_archive": False,
+    # 附加上传目标，每张截图同时上传到主FTP服务器和这些目标，例如:
+    # {"name": "backup", "type": "ftp", "host": "...", "port": 21, "user": "...", "password": "...",
+    #  "directory": "/南安/", "encoding": "gbk"}
+    # {"name": "sftp", "type": "sftp", "host": "...", "port": 22, "user": "...", "password": "...", "directory": "/data"}
+    # {"name": "nas", "type": "local", "directory": "/mnt/nas/截图"}
+    "destinations": [],
+    # 上传限速（KB/s，为None时不限速），所有上传目标共用；启用后按往返时间自动降低/恢复速率，
+    # 且交互截图上传期间暂停缓存积压的上传
+    "upload_rate_limit": None,
+    "upload_rate_adaptive": True,
+    # 上传文件名格式（不含扩展名）: time 截图时间, ms 毫秒, host 主机名, seq 本次运行中的序号
+    "filename_pattern": "screenshot_{time:%Y%m%d_%H%M%S}_{ms:03d}_{host}_{seq:04d}",
+    # 上传目录下按截图日期分子目录，如 "{year}/{month}/{day}"，为空时全部放在上传目录中
+    "remote_layout": "",
+    # 统计导出: Prometheus文本文件（为空时使用数据目录下的metrics.prom），端口为None时不启动HTTP服务
+    "metrics_file": None,
+    "metrics_port": None,
+}
+
+def load_config(path=None):
+    """读取配置文件，缺少的项使用默认值；未指定路径且默认配置文件不存在时全部使用默认值"""
+    config = dict(DEFAULT_CONFIG)
+    if path is None:
+        path = os.path.join(get_app_config_dir(), CONFIG_FILE)
+        if not os.path.exists(path):
+            path = None
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            config.update(json.load(f))
+    if not config["metrics_file"]:
+        config["metrics_file"] = os.path.join(get_app_data_dir(), "metrics.prom")
+    return config
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """按大小或日期滚动的日志文件，滚动后的旧文件用gzip压缩"""
+    def __init__(self, filename, max_bytes=5 * 1024 * 1024, backup_count=10, rotate_daily=True):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.rotate_daily = rotate_daily
+        self.current_day = date.today()
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self.compress
+    
+    def shouldRollover(self, record):
+        if self.rotate_daily and date.today() != self.current_day:
+            return True
+        return super().shouldRollover(record)
+    
+    def doRollover(self):
+        super().doRollover()
+        self.current_day = date.today()
+    
+    @staticmethod
+    def compress(source, dest):
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+class JsonLineFormatter(logging.Formatter):
+    """每条日志输出为一行JSON"""
+    def format(self, record):
+        return json.dumps({
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": getattr(record, "level", record.levelname.lower()),
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }, ensure_ascii=False)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时直接丢弃日志，调用线程永远不会阻塞"""
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+    
+    def prepare(self, record):
+        # 消息均为已格式化的字符串，无需在调用线程中再次格式化
+        return record
+
+class FileLogSink:
+    """日志文件输出：调用线程只负责入队，写文件、滚动和压缩都在独立的写线程中完成"""
+    LEVELS = {"info": logging.INFO, "success": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+    
+    def __init__(self, path, max_bytes=5 * 1024 * 1024, backup_count=10, rotate_daily=True, queue_size=10000):
+        self.handler = CompressingRotatingFileHandler(path, max_bytes, backup_count, rotate_daily)
+        self.handler.setFormatter(JsonLineFormatter())
+        
+        log_queue = queue.Queue(maxsize=queue_size)
+        self.queue_handler = DroppingQueueHandler(log_queue)
+        self.logger = logging.getLogger(f"{APP_NAME}.file")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.queue_handler)
+        self.listener = logging.handlers.QueueListener(log_queue, self.handler)
+        self.listener.start()
+    
+    def write(self, message, level):
+        self.logger.log(self.LEVELS.get(level, logging.INFO), message, extra={"level": level})
+    
+    def close(self):
+        """写出队列中剩余的日志并关闭文件"""
+        if self.listener:
+            self.logger.removeHandler(self.queue_handler)
+            self.listener.stop()
+            self.listener = None
+            self.handler.close()
+
 class Logger(QObject):
     log_signal = pyqtSignal(str, str)  # 消息, 级别
     
-    def __init__(self):
+    def __init__(self, file_sink=None):
         super().__init__()
+        self.file_sink = file_sink
+    
+    def log(self, message, level):
+        self.log_signal.emit(message, level)
+        if self.file_sink:
+            self.file_sink.write(message, level)
     
     def info(self, message):
-        self.log_signal.emit(message, "info")
+        self.log(message, "info")
     
     def error(self, message):
-        self.log_signal.emit(message, "error")
+        self.log(message, "error")
     
     def success(self, message):
-        self.log_signal.emit(message, "success")
+        self.log(message, "success")
     
     def warning(self, message):
-        self.log_signal.emit(message, "warning")
+        self.log(message, "warning")
+    
+    def close(self):
+        if self.file_sink:
+            self.file_sink.close()
+            self.file_sink = None
+
+class PipelineMetrics:
+    """截图流水线各阶段的耗时、上传字节数等统计，只保存在内存中"""
+    STAGES = ("clipboard_wait", "grab", "preprocess", "encode", "connect", "login", "cwd", "transfer", "total")
+    # 由流水线时间点计算的阶段: 阶段 -> (开始时间点, 结束时间点)
+    STAGE_MARKS = {
+        "clipboard_wait": ("key_event", "clipboard_ready"),
+        "grab": ("clipboard_ready", "grabbed"),
+        "encode": ("encode_start", "encoded"),
+        "total": ("key_event", "done"),
+    }
+    QUANTILES = (0.5, 0.95, 0.99)
+    
+    def __init__(self, max_samples=1024):
+        self.lock = threading.Lock()
+        self.samples = {stage: deque(maxlen=max_samples) for stage in self.STAGES}
+        self.sums = dict.fromkeys(self.STAGES, 0.0)
+        self.counts = dict.fromkeys(self.STAGES, 0)
+        self.uploads_succeeded = 0
+        self.uploads_failed = 0
+        # 上传目标 -> [成功次数, 失败次数]
+        self.target_uploads = {}
+        self.bytes_sent = 0
+        self.transfer_seconds = 0.0
+        # 断点续传时无需重新发送的字节数
+        self.bytes_resumed = 0
+        # 预处理前后的像素数
+        self.pixels_in = 0
+        self.pixels_out = 0
+        # 当前上传限速（字节/秒），不限速时为None
+        self.rate_limit = None
+        # 排队截图占用的内存和溢出到磁盘的字节数，以及因超出内存预算丢弃的截图数
+        self.memory_used = 0
+        self.memory_spilled = 0
+        self.frames_dropped = 0
+    
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.samples[stage].append(seconds)
+            self.sums[stage] += seconds
+            self.counts[stage] += 1
+    
+    def observe_marks(self, marks):
+        """根据 time.monotonic() 记录的时间点统计各阶段耗时"""
+        for stage, (start, end) in self.STAGE_MARKS.items():
+            if start in marks and end in marks:
+                self.observe(stage, marks[end] - marks[start])
+    
+    def record_transfer(self, nbytes, seconds):
+        self.observe("transfer", seconds)
+        with self.lock:
+            self.bytes_sent += nbytes
+            self.transfer_seconds += seconds
+    
+    def record_preprocess(self, pixels_in, pixels_out, seconds):
+        self.observe("preprocess", seconds)
+        with self.lock:
+            self.pixels_in += pixels_in
+            self.pixels_out += pixels_out
+    
+    def record_resumed(self, nbytes):
+        with self.lock:
+            self.bytes_resumed += nbytes
+    
+    def record_rate_limit(self, rate):
+        with self.lock:
+            self.rate_limit = rate
+    
+    def record_memory(self, used, spilled):
+        with self.lock:
+            self.memory_used = used
+            self.memory_spilled = spilled
+    
+    def record_dropped(self):
+        with self.lock:
+            self.frames_dropped += 1
+    
+    def record_upload(self, success, target="primary"):
+        with self.lock:
+            counts = self.target_uploads.setdefault(target, [0, 0])
+            if success:
+                self.uploads_succeeded += 1
+                counts[0] += 1
+            else:
+                self.uploads_failed += 1
+                counts[1] += 1
+    
+    @staticmethod
+    def percentile(sorted_values, q):
+        if not sorted_values:
+            return 0.0
+        index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+        return sorted_values[index]
+    
+    def snapshot(self):
+        """返回 {阶段: (次数, 总耗时, [p50, p95, p99])} 及计数器"""
+        with self.lock:
+            stages = {}
+            for stage in self.STAGES:
+                values = sorted(self.samples[stage])
+                stages[stage] = (self.counts[stage], self.sums[stage], [self.percentile(values, q) for q in self.QUANTILES])
+            counters = {
+                "uploads_succeeded": self.uploads_succeeded,
+                "uploads_failed": self.uploads_failed,
+                "targets": {target: tuple(counts) for target, counts in self.target_uploads.items()},
+                "bytes_sent": self.bytes_sent,
+                "bytes_resumed": self.bytes_resumed,
+                "throughput": self.bytes_sent / self.transfer_seconds if self.transfer_seconds else 0.0,
+                "pixels_in": self.pixels_in,
+                "pixels_out": self.pixels_out,
+                "rate_limit": self.rate_limit,
+                "memory_used": self.memory_used,
+                "memory_spilled": self.memory_spilled,
+                "frames_dropped": self.frames_dropped,
+            }
+        return stages, counters
+    
+    def format_summary(self):
+        """生成统计面板显示的文本"""
+        stages, counters = self.snapshot()
+        lines = [f"{'阶段':<14}{'次数':>6}{'p50':>9}{'p95':>9}{'p99':>9}"]
+        for stage, (count, _, quantiles) in stages.items():
+            if count:
+                lines.append(f"{stage:<16}{count:>6}" + "".join(f"{q * 1000:>7.0f}ms" for q in quantiles))
+        lines.append(f"成功 {counters['uploads_succeeded']} / 失败 {counters['uploads_failed']}，"
+                     f"已发送 {counters['bytes_sent'] / 1024:.0f} KB，"
+                     f"平均速率 {counters['throughput'] / 1024:.0f} KB/s")
+        if counters["bytes_resumed"]:
+            lines.append(f"断点续传节省 {counters['bytes_resumed'] / 1024:.0f} KB")
+        if counters["rate_limit"]:
+            lines.append(f"当前限速 {counters['rate_limit'] / 1024:.0f} KB/s")
+        if counters["memory_used"] or counters["memory_spilled"] or counters["frames_dropped"]:
+            lines.append(f"排队截图占用内存 {counters['memory_used'] / 1024 / 1024:.0f} MB，"
+                         f"溢出到磁盘 {counters['memory_spilled'] / 1024 / 1024:.0f} MB，"
+                         f"超出预算丢弃 {counters['frames_dropped']} 张")
+        if len(counters["targets"]) > 1:
+            lines.append("，".join(f"{target}: 成功 {succeeded} / 失败 {failed}"
+                                  for target, (succeeded, failed) in counters["targets"].items()))
+        if counters["pixels_in"]:
+            saved = 1 - counters["pixels_out"] / counters["pixels_in"]
+            lines.append(f"预处理减少像素 {saved:.0%}（{counters['pixels_in'] / 1e6:.1f} → {counters['pixels_out'] / 1e6:.1f} 百万像素）")
+        return "\n".join(lines)
+    
+    def to_prometheus(self):
+        """导出为Prometheus文本格式"""
+        stages, counters = self.snapshot()
+        lines = [
+            "# HELP screenshot_stage_seconds Latency of each capture pipeline stage.",
+            "# TYPE screenshot_stage_seconds summary",
+        ]
+        for stage, (count, total, quantiles) in stages.items():
+            for q, value in zip(self.QUANTILES, quantiles):
+                lines.append(f'screenshot_stage_seconds{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+            lines.append(f'screenshot_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'screenshot_stage_seconds_count{{stage="{stage}"}} {count}')
+        lines += [
+            "# HELP screenshot_uploads_total Finished upload attempts by destination and result.",
+            "# TYPE screenshot_uploads_total counter",
+        ]
+        for target, (succeeded, failed) in counters["targets"].items():
+            lines.append(f'screenshot_uploads_total{{target="{target}",result="success"}} {succeeded}')
+            lines.append(f'screenshot_uploads_total{{target="{target}",result="failure"}} {failed}')
+        lines += [
+            "# HELP screenshot_bytes_sent_total Bytes sent with STOR.",
+            "# TYPE screenshot_bytes_sent_total counter",
+            f"screenshot_bytes_sent_total {counters['bytes_sent']}",
+            "# HELP screenshot_bytes_resumed_total Bytes not resent because an interrupted upload was resumed.",
+            "# TYPE screenshot_bytes_resumed_total counter",
+            f"screenshot_bytes_resumed_total {counters['bytes_resumed']}",
+            "# HELP screenshot_upload_throughput_bytes Average STOR throughput in bytes per second.",
+            "# TYPE screenshot_upload_throughput_bytes gauge",
+            f"screenshot_upload_throughput_bytes {counters['throughput']:.1f}",
+            "# HELP screenshot_preprocess_pixels_total Pixels before and after pre-processing.",
+            "# TYPE screenshot_preprocess_pixels_total counter",
+            f'screenshot_preprocess_pixels_total{{stage="input"}} {counters["pixels_in"]}',
+            f'screenshot_preprocess_pixels_total{{stage="output"}} {counters["pixels_out"]}',
+            "# HELP screenshot_pipeline_memory_bytes Bytes held by queued captures, in memory or spilled to disk.",
+            "# TYPE screenshot_pipeline_memory_bytes gauge",
+            f'screenshot_pipeline_memory_bytes{{state="memory"}} {counters["memory_used"]}',
+            f'screenshot_pipeline_memory_bytes{{state="spilled"}} {counters["memory_spilled"]}',
+            "# HELP screenshot_frames_dropped_total Captures dropped because the memory budget was exceeded.",
+            "# TYPE screenshot_frames_dropped_total counter",
+            f"screenshot_frames_dropped_total {counters['frames_dropped']}",
+        ]
+        if counters["rate_limit"]:
+            lines += [
+                "# HELP screenshot_upload_rate_limit_bytes Current upload rate limit in bytes per second.",
+                "# TYPE screenshot_upload_rate_limit_bytes gauge",
+                f"screenshot_upload_rate_limit_bytes {counters['rate_limit']:.0f}",
+            ]
+        return "\n".join(lines) + "\n"
+
+class MetricsExporter:
+    """定期将统计写入Prometheus文本文件，可选在本机端口提供 /metrics"""
+    def __init__(self, metrics, path=None, port=None, interval=15.0):
+        self.metrics = metrics
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.server = None
+    
+    def start(self):
+        if self.path:
+            self.thread = threading.Thread(target=self._write_loop, name="metrics-writer", daemon=True)
+            self.thread.start()
+        if self.port:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+            metrics = self.metrics
+            
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = metrics.to_prometheus().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                
+                def log_message(self, format, *args):
+                    pass
+            
+            # 只监听本机地址
+            self.server = ThreadingHTTPServer(("127.0.0.1", self.port), MetricsHandler)
+            threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+    
+    def _write_loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+    
+    def write(self):
+        try:
+            write_file_atomic(self.path, self.metrics.to_prometheus().encode("utf-8"))
+        except OSError:
+            pass
+    
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+            self.write()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
 
 # 中文路径编码尝试函数
 def get_encoded_paths(original_path):
@@ -106,150 +595,811 @@ def get_encoded_paths(original_path):
     return unique_paths
 
 class FTPTestThread(QThread):
+    """并发探测候选目录，找到第一个可上传的目录"""
     # 创建信号用于通知主线程测试结果
     finished = pyqtSignal(bool, str)
     log_signal = pyqtSignal(str, str)
     
-    def __init__(self, host, user, password, path_candidates):
+    def __init__(self, host, user, password, path_candidates, max_connections=4, encoding='gbk', port=21):
         super().__init__()
         self.host = host
+        self.port = port
         self.user = user
         self.password = password
         self.path_candidates = path_candidates
+        self.max_connections = max_connections
+        self.encoding = encoding
         self.working_directory = None
+        
+        # 探测状态，由各连接线程共享
+        self.condition = threading.Condition()
+        self.pending = []
+        self.results = {}
+        self.best_index = None
+        self.active_workers = 0
+        self.last_error = None
     
     def run(self):
         """线程运行的主函数，执行FTP连接测试"""
         self.log_signal.emit(f"开始测试FTP连接: {self.host}", "info")
+        self.pending = list(enumerate(self.path_candidates))
+        self.results = {}
+        self.best_index = None
+        
+        # 每个连接线程依次领取候选目录进行探测
+        worker_count = max(1, min(self.max_connections, len(self.pending)))
+        self.active_workers = worker_count
+        self.log_signal.emit(f"使用 {worker_count} 个连接并发探测 {len(self.pending)} 个候选目录", "info")
+        for i in range(worker_count):
+            threading.Thread(target=self._probe_worker, name=f"ftp-probe-{i}", daemon=True).start()
+        
+        # 排在最前的可用目录确定后即可结束，无需等待其余探测
+        with self.condition:
+            while not self._decided():
+                self.condition.wait()
+            best_index = self.best_index
+            last_error = self.last_error
+        
+        if best_index is not None:
+            self.working_directory = self.path_candidates[best_index]
+            self.log_signal.emit(f"已找到可上传的目录: {self.working_directory}", "success")
+            self.finished.emit(True, f"FTP连接测试成功！可以上传文件到目录: {self.working_directory}")
+        elif not self.results and last_error:
+            self.log_signal.emit(f"FTP连接测试失败: {last_error}", "error")
+            self.finished.emit(False, f"FTP连接测试失败: {last_error}")
+        else:
+            self.log_signal.emit("未找到可上传的目录，请检查账户权限", "error")
+            self.finished.emit(False, "未找到可上传的目录，请检查账户权限")
+    
+    def _decided(self):
+        if self.active_workers == 0:
+            return True
+        return self.best_index is not None and all(i in self.results for i in range(self.best_index))
+    
+    def _next_candidate(self):
+        """领取下一个候选目录，已有更靠前的可用目录时返回None"""
+        with self.condition:
+            if not self.pending:
+                return None
+            index, path = self.pending[0]
+            if self.best_index is not None and index > self.best_index:
+                return None
+            return self.pending.pop(0)
+    
+    def _probe_worker(self):
+        ftp = None
         try:
             # 连接FTP服务器
-            ftp = FTP(self.host)
-            ftp.encoding = 'gbk'  # 设置FTP服务器编码为GBK
-            self.log_signal.emit(f"尝试登录FTP: 用户名={self.user}", "info")
+            ftp = FTP()
+            # 编码须在连接前设置，ftplib连接时按此编码创建读取服务器响应的文件对象
+            ftp.encoding = self.encoding
+            ftp.connect(self.host, self.port)
             ftp.login(user=self.user, passwd=self.password)
-            self.log_signal.emit("FTP登录成功", "success")
+            home = ftp.pwd()
             
-            # 列出根目录内容，帮助调试
-            self.log_signal.emit("列出根目录内容:", "info")
-            try:
-                root_dirs = ftp.nlst()
-                for item in root_dirs:
-                    self.log_signal.emit(f"  - {item}", "info")
-            except Exception as e:
-                self.log_signal.emit(f"无法列出根目录内容: {str(e)}", "warning")
-            
-            # 尝试所有候选路径
-            success = False
-            for path in self.path_candidates:
+            while True:
+                candidate = self._next_candidate()
+                if candidate is None:
+                    break
+                index, path = candidate
                 try:
-                    self.log_signal.emit(f"尝试切换到目录: {path}", "info")
-                    ftp.cwd(path)
-                    self.log_signal.emit(f"成功访问目录: {path}", "success")
-                    
-                    # 列出当前目录内容
-                    try:
-                        dir_list = ftp.nlst()
-                        self.log_signal.emit("当前目录内容:", "info")
-                        if dir_list:
-                            for item in dir_list:
-                                self.log_signal.emit(f"  - {item}", "info")
-                        else:
-                            self.log_signal.emit("  (目录为空)", "info")
-                    except Exception as e:
-                        self.log_signal.emit(f"无法列出目录内容: {str(e)}", "warning")
-                    
-                    # 测试上传权限
-                    test_data = io.BytesIO(b"FTP connection test")
-                    test_filename = f"test_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-                    
-                    try:
-                        self.log_signal.emit(f"尝试上传测试文件: {test_filename}", "info")
-                        ftp.storbinary(f'STOR {test_filename}', test_data)
-                        self.log_signal.emit("测试文件上传成功", "success")
-                        
-                        # 记住成功的路径
-                        self.working_directory = path
-                        success = True
-                        
-                        # 尝试删除测试文件
-                        try:
-                            ftp.delete(test_filename)
-                            self.log_signal.emit("测试文件已删除", "info")
-                        except:
-                            self.log_signal.emit("无法删除测试文件，但这可能是正常的", "warning")
-                        
-                        break  # 成功找到可用路径，退出循环
-                    except error_perm as e:
-                        self.log_signal.emit(f"在目录 {path} 中无法上传文件: {str(e)}", "error")
-                        # 继续尝试下一个路径
-                except error_perm as e:
-                    self.log_signal.emit(f"无法访问目录 {path}: {str(e)}", "error")
-                    # 继续尝试下一个路径
+                    success = self._probe(ftp, home, path)
+                except Exception:
+                    # 连接已断开，该候选目录视为不可用并结束本线程
+                    with self.condition:
+                        self.results[index] = False
+                    raise
+                with self.condition:
+                    self.results[index] = success
+                    if success and (self.best_index is None or index < self.best_index):
+                        self.best_index = index
+                    self.condition.notify_all()
+        except Exception as e:
+            with self.condition:
+                self.last_error = str(e)
+        finally:
+            if ftp is not None:
+                try:
+                    ftp.quit()
+                except Exception:
+                    ftp.close()
+            with self.condition:
+                self.active_workers -= 1
+                self.condition.notify_all()
+    
+    def _probe(self, ftp, home, path):
+        """切换到目录并上传、删除测试文件，返回是否可上传"""
+        try:
+            # 相对路径需从登录目录开始切换
+            if not path.startswith("/"):
+                ftp.cwd(home)
+            ftp.cwd(path)
+        except error_perm as e:
+            self.log_signal.emit(f"无法访问目录 {path}: {str(e)}", "error")
+            return False
+        
+        # 测试上传权限
+        test_data = io.BytesIO(b"FTP connection test")
+        test_filename = f"test_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{threading.get_ident()}.txt"
+        try:
+            ftp.storbinary(f'STOR {test_filename}', test_data)
+        except error_perm as e:
+            self.log_signal.emit(f"在目录 {path} 中无法上传文件: {str(e)}", "error")
+            return False
+        self.log_signal.emit(f"目录 {path} 可以上传文件", "success")
+        
+        # 尝试删除测试文件
+        try:
+            ftp.delete(test_filename)
+        except Exception:
+            self.log_signal.emit("无法删除测试文件，但这可能是正常的", "warning")
+        return True
+
+class FTPRevalidateThread(QThread):
+    """后台验证缓存的上传目录是否仍然可用，同时为连接池预热一个会话"""
+    finished = pyqtSignal(bool, str)
+    
+    def __init__(self, ftp_uploader):
+        super().__init__()
+        self.ftp_uploader = ftp_uploader
+    
+    def run(self):
+        pool = self.ftp_uploader.pool
+        try:
+            ftp = pool.acquire()
+        except error_perm as e:
+            self.finished.emit(False, f"缓存的上传目录已不可用: {e}")
+            return
+        except Exception as e:
+            # 服务器暂时不可达时保留缓存，截图会留在本地缓存中等待重试
+            self.finished.emit(True, f"暂时无法连接FTP服务器，继续使用缓存的目录: {e}")
+            return
+        pool.release(ftp)
+        self.finished.emit(True, "缓存的上传目录验证通过")
+
+class FTPConnectionPool:
+    """FTP会话池，保持已登录并位于工作目录中的连接以便复用"""
+    def __init__(self, host, user, password, logger, max_idle=2, keepalive_interval=60, timeout=30, metrics=None,
+                 port=21):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.logger = logger
+        self.max_idle = max_idle
+        self.keepalive_interval = keepalive_interval
+        self.timeout = timeout
+        self.metrics = metrics
+        self.working_directory = None
+        self.encoding = 'gbk'
+        
+        # 空闲会话列表: (ftp, 最后使用时间)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.keepalive_thread = None
+    
+    def set_working_directory(self, path):
+        """切换工作目录，已有会话位于旧目录中，全部关闭"""
+        with self.lock:
+            self.working_directory = path
+            sessions = [ftp for ftp, _ in self.idle]
+            self.idle = []
+        for ftp in sessions:
+            self.discard(ftp)
+    
+    def connect(self):
+        """建立新会话：连接、登录并切换到工作目录"""
+        self.logger.info(f"正在连接FTP服务器: {self.host}")
+        start = time.monotonic()
+        ftp = FTP(timeout=self.timeout)
+        ftp.encoding = self.encoding  # FTP服务器编码，默认为GBK，须在连接前设置
+        ftp.connect(self.host, self.port)
+        connected = time.monotonic()
+        try:
+            ftp.login(user=self.user, passwd=self.password)
+            self.logger.info("FTP登录成功")
+            logged_in = time.monotonic()
             
+            # 切换到目标目录
+            self.logger.info(f"切换到目录: {self.working_directory}")
+            ftp.cwd(self.working_directory)
+            if self.metrics:
+                self.metrics.observe("connect", connected - start)
+                self.metrics.observe("login", logged_in - connected)
+                self.metrics.observe("cwd", time.monotonic() - logged_in)
+        except Exception:
+            self.discard(ftp)
+            raise
+        return ftp
+    
+    def acquire(self):
+        """取出一个可用会话，空闲过久的会话先用NOOP检查是否存活"""
+        self.start_keepalive()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                ftp, last_used = self.idle.pop()
+            
+            if time.monotonic() - last_used < self.keepalive_interval:
+                return ftp
+            try:
+                ftp.voidcmd('NOOP')
+                return ftp
+            except Exception:
+                # 服务器已超时断开，丢弃后尝试下一个
+                self.discard(ftp)
+        
+        return self.connect()
+    
+    def release(self, ftp):
+        """归还会话，超出空闲上限时直接关闭"""
+        with self.lock:
+            if len(self.idle) < self.max_idle and not self.stop_event.is_set():
+                self.idle.append((ftp, time.monotonic()))
+                return
+        self.discard(ftp)
+    
+    def discard(self, ftp):
+        """关闭会话，忽略连接已断开等错误"""
+        try:
             ftp.quit()
+        except Exception:
+            ftp.close()
+    
+    def start_keepalive(self):
+        if self.keepalive_thread is None and self.keepalive_interval:
+            self.stop_event.clear()
+            self.keepalive_thread = threading.Thread(target=self._keepalive_loop, name="ftp-keepalive", daemon=True)
+            self.keepalive_thread.start()
+    
+    def _keepalive_loop(self):
+        """定期对空闲会话发送NOOP，防止被服务器超时断开"""
+        while not self.stop_event.wait(self.keepalive_interval):
+            now = time.monotonic()
+            with self.lock:
+                due = [item for item in self.idle if now - item[1] >= self.keepalive_interval]
+                self.idle = [item for item in self.idle if now - item[1] < self.keepalive_interval]
             
-            if success:
-                self.log_signal.emit(f"已找到可上传的目录: {self.working_directory}", "success")
-                self.finished.emit(True, f"FTP连接测试成功！可以上传文件到目录: {self.working_directory}")
+            for ftp, _ in due:
+                try:
+                    ftp.voidcmd('NOOP')
+                except Exception:
+                    self.discard(ftp)
+                    continue
+                self.release(ftp)
+    
+    def close(self):
+        """停止保活线程并关闭所有空闲会话"""
+        self.stop_event.set()
+        if self.keepalive_thread:
+            self.keepalive_thread.join()
+            self.keepalive_thread = None
+        with self.lock:
+            sessions = [ftp for ftp, _ in self.idle]
+            self.idle = []
+        for ftp in sessions:
+            self.discard(ftp)
+
+class StreamPipe:
+    """有界内存管道：编码线程写入的同时上传线程读取，编码与传输重叠进行"""
+    def __init__(self, capacity=1024 * 1024):
+        self.capacity = capacity
+        self.chunks = deque()
+        self.size = 0
+        self.closed = False
+        self.error = None
+        self.bytes_read = 0
+        self.condition = threading.Condition()
+    
+    def write(self, data):
+        """写入数据，缓冲区已满时阻塞"""
+        data = bytes(data)
+        with self.condition:
+            while self.size >= self.capacity and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise BrokenPipeError(self.error)
+            self.chunks.append(data)
+            self.size += len(data)
+            self.condition.notify_all()
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def read(self, size=-1):
+        """读取最多size字节，写入端关闭且数据读完时返回空字节串"""
+        with self.condition:
+            while not self.chunks and not self.closed and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise OSError(self.error)
+            
+            parts = []
+            remaining = size if size >= 0 else self.size
+            while self.chunks and remaining > 0:
+                chunk = self.chunks.popleft()
+                if len(chunk) > remaining:
+                    self.chunks.appendleft(chunk[remaining:])
+                    chunk = chunk[:remaining]
+                parts.append(chunk)
+                remaining -= len(chunk)
+            data = b"".join(parts)
+            self.size -= len(data)
+            self.bytes_read += len(data)
+            self.condition.notify_all()
+            return data
+    
+    def close(self):
+        """写入结束"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+    
+    def abort(self, reason):
+        """任一端出错时中止，唤醒另一端"""
+        with self.condition:
+            self.error = reason
+            self.condition.notify_all()
+
+class BandwidthLimiter:
+    """所有上传共用的令牌桶限速器
+    交互截图上传期间暂停缓存积压的上传；启用自适应时按往返时间调整速率：
+    往返时间明显高于近期最小值时乘性降低，否则加性恢复到上限"""
+    INTERACTIVE = 0
+    BACKLOG = 1
+    
+    def __init__(self, max_rate, adaptive=True, min_rate=None, burst=None, metrics=None):
+        # 速率单位均为字节/秒
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.min_rate = min_rate or min(max_rate, max(16 * 1024, max_rate / 10))
+        self.burst = burst or max(64 * 1024, max_rate / 4)
+        self.adaptive = adaptive
+        self.metrics = metrics
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        # 各优先级正在进行的上传数
+        self.active = [0, 0]
+        self.rtt_samples = deque(maxlen=32)
+        self.condition = threading.Condition()
+        if metrics:
+            metrics.record_rate_limit(self.rate)
+    
+    @contextlib.contextmanager
+    def transfer(self, priority):
+        """标记一次上传的开始和结束"""
+        with self.condition:
+            self.active[priority] += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active[priority] -= 1
+                self.condition.notify_all()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def acquire(self, nbytes, priority=INTERACTIVE):
+        """等待发送nbytes字节的令牌，允许透支，下次调用时补足"""
+        with self.condition:
+            while True:
+                if priority == self.BACKLOG and self.active[self.INTERACTIVE]:
+                    self.condition.wait()
+                    continue
+                self._refill()
+                if self.tokens >= 0:
+                    self.tokens -= nbytes
+                    return
+                self.condition.wait(-self.tokens / self.rate)
+    
+    def record_rtt(self, seconds):
+        """记录一次往返时间样本（数据发送完毕到服务器确认的时间），并调整速率"""
+        if not self.adaptive:
+            return
+        with self.condition:
+            self.rtt_samples.append(seconds)
+            base = min(self.rtt_samples)
+            if len(self.rtt_samples) >= 4 and seconds > base * 2 + 0.02:
+                # 链路排队，降低速率
+                self.rate = max(self.min_rate, self.rate * 0.7)
             else:
-                self.log_signal.emit("未找到可上传的目录，请检查账户权限", "error")
-                self.finished.emit(False, "未找到可上传的目录，请检查账户权限")
-                
-        except Exception as e:
-            self.log_signal.emit(f"FTP连接测试失败: {str(e)}", "error")
-            self.finished.emit(False, f"FTP连接测试失败: {str(e)}")
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+            rate = self.rate
+        if self.metrics:
+            self.metrics.record_rate_limit(rate)
+
+class ThrottledReader:
+    """按限速器分配的令牌读取数据，供 storbinary/putfo 使用"""
+    def __init__(self, source, limiter, priority):
+        self.source = source
+        self.limiter = limiter
+        self.priority = priority
+        # 读到末尾的时间，之后的等待即为服务器确认所需的时间
+        self.eof_time = None
+    
+    def read(self, size=-1):
+        data = self.source.read(size)
+        if data:
+            self.limiter.acquire(len(data), self.priority)
+        else:
+            self.eof_time = time.monotonic()
+        return data
+    
+    def tell(self):
+        return self.source.tell()
 
 class FTPUploader:
-    def __init__(self, host, user, password, logger):
+    def __init__(self, host, user, password, logger, metrics=None, blocksize=64 * 1024, port=21, name="primary"):
+        # 上传目标名称，用于日志、统计和本地缓存中的上传状态
+        self.name = name
         self.host = host
+        self.port = port
         self.user = user
         self.password = password
         self.logger = logger
+        self.metrics = metrics
+        # STOR时每次读取并发送的字节数（ftplib默认为8 KiB）
+        self.blocksize = blocksize
+        self.pool = FTPConnectionPool(host, user, password, logger, metrics=metrics, port=port)
         self.working_directory = None  # 将在连接测试时设置
+        # 上传限速器，为None时不限速
+        self.limiter = None
+        # 上传中断、服务器上留有临时文件的文件名，重试时从已上传的大小处继续
+        self.partial_uploads = set()
+        # 工作目录下已确认存在的子目录，不再重复MKD
+        self.known_directories = set()
         
         # 获取所有可能的编码路径
         self.path_candidates = get_encoded_paths("/南安/")
     
+    @property
+    def working_directory(self):
+        return self.pool.working_directory
+    
+    @working_directory.setter
+    def working_directory(self, path):
+        self.pool.set_working_directory(path)
+    
+    def is_ready(self):
+        """工作目录确定之后才能上传"""
+        return bool(self.working_directory)
+    
     def test_connection(self):
         """创建并返回测试线程，不阻塞主线程"""
-        self.test_thread = FTPTestThread(self.host, self.user, self.password, self.path_candidates)
+        self.test_thread = FTPTestThread(self.host, self.user, self.password, self.path_candidates,
+                                         encoding=self.pool.encoding, port=self.port)
         
         # 连接日志信号
-        self.test_thread.log_signal.connect(self.logger.log_signal.emit)
+        self.test_thread.log_signal.connect(self.logger.log)
         
         return self.test_thread
+    
+    def upload_image(self, image_data, filename, priority=BandwidthLimiter.INTERACTIVE):
+        """上传图像到FTP服务器，复用连接池中的会话"""
+        return self.upload_batch([(filename, image_data)], priority)[0]
+    
+    @staticmethod
+    def temp_name(filename):
+        """上传过程中使用的临时文件名，完成后才改为正式文件名，读取方不会看到不完整的文件"""
+        return f"{filename}.part"
+    
+    def _remote_size(self, ftp, name):
+        """服务器上文件的大小，文件不存在或服务器不支持SIZE时返回0"""
+        try:
+            ftp.voidcmd("TYPE I")
+            return ftp.size(name) or 0
+        except error_perm:
+            return 0
+    
+    def _ensure_directory(self, ftp, directory):
+        """逐级创建工作目录下的子目录（已存在时忽略错误），确认后记入缓存"""
+        if not directory or directory in self.known_directories:
+            return
+        path = ""
+        for part in directory.split("/"):
+            path = posixpath.join(path, part)
+            try:
+                ftp.mkd(path)
+            except error_perm:
+                # 目录已存在
+                pass
+        self.known_directories.add(directory)
+    
+    def _rename(self, ftp, source, target):
+        try:
+            ftp.rename(source, target)
+        except error_perm:
+            # 部分服务器不允许覆盖已有文件
+            ftp.delete(target)
+            ftp.rename(source, target)
+    
+    def _store(self, ftp, filename, source, priority, resume=True):
+        """上传到临时文件后改名，之前中断过的文件用APPE从服务器上已有的大小处继续
+        filename可以带工作目录下的子目录；限速时按令牌发送并记录往返时间，返回 (耗时, 本次发送的字节数)"""
+        self._ensure_directory(ftp, posixpath.dirname(filename))
+        temp_name = self.temp_name(filename)
+        offset = total = 0
+        if resume:
+            if filename in self.partial_uploads:
+                offset = self._remote_size(ftp, temp_name)
+                total = source.seek(0, os.SEEK_END)
+                if not 0 < offset <= total:
+                    offset = 0
+                elif offset < total:
+                    self.logger.info(f"从 {offset} 字节处继续上传: {filename}")
+                if offset and self.metrics:
+                    self.metrics.record_resumed(offset)
+            source.seek(offset)
         
-    def upload_image(self, image_data, filename):
-        """上传图像到FTP服务器"""
+        start = time.monotonic()
+        # 流式上传的数据无法重新读取，失败后由缓存重新编码上传，内容不一定相同，不能从中断处继续
+        if resume:
+            self.partial_uploads.add(filename)
+        reader = ThrottledReader(source, self.limiter, priority) if self.limiter else source
+        if offset == 0 or offset < total:
+            ftp.storbinary(f'{"APPE" if offset else "STOR"} {temp_name}', reader, self.blocksize)
+        end = time.monotonic()
+        if self.limiter and reader.eof_time:
+            self.limiter.record_rtt(end - reader.eof_time)
+        self._rename(ftp, temp_name, filename)
+        self.partial_uploads.discard(filename)
+        sent = source.tell() - offset if resume else source.bytes_read
+        return end - start, sent
+    
+    def upload_batch(self, files, priority=BandwidthLimiter.INTERACTIVE):
+        """在同一个FTP会话中依次上传多个文件，返回每个文件是否上传成功"""
+        if not self.working_directory:
+            self.logger.error("未设置有效的工作目录，无法上传文件")
+            return [False] * len(files)
+        
+        with self.limiter.transfer(priority) if self.limiter else contextlib.nullcontext():
+            return self._upload_batch(files, priority)
+    
+    def _upload_batch(self, files, priority):
+        results = []
+        ftp = None
+        for filename, image_data in files:
+            self.logger.info(f"开始上传图片: {filename}")
+            success = False
+            for attempt in range(2):
+                if ftp is None:
+                    try:
+                        ftp = self.pool.acquire()
+                    except Exception as e:
+                        # 无法连接时其余文件同样无法上传
+                        self.logger.error(f"FTP连接错误: {e}")
+                        return results + [False] * (len(files) - len(results))
+                
+                try:
+                    # 上传文件
+                    self.logger.info(f"开始上传文件: {filename}")
+                    seconds, sent = self._store(ftp, filename, image_data, priority)
+                    if self.metrics:
+                        self.metrics.record_transfer(sent, seconds)
+                except (error_temp, EOFError, OSError) as e:
+                    # 421、超时或连接被服务器关闭，重新连接后重试一次
+                    self.pool.discard(ftp)
+                    ftp = None
+                    if attempt == 0:
+                        self.logger.warning(f"FTP会话已失效，重新连接: {e}")
+                        continue
+                    self.logger.error(f"FTP上传错误: {e}")
+                    break
+                except error_perm as e:
+                    directory = posixpath.dirname(filename)
+                    if attempt == 0 and str(e).startswith("550") and directory in self.known_directories:
+                        # 子目录可能已在服务器上被删除，重新创建后重试
+                        self.logger.warning(f"上传目录不可用，重新创建: {directory}")
+                        self.known_directories.discard(directory)
+                        continue
+                    # 单个文件被拒绝时会话仍然可用，继续上传后面的文件
+                    self.logger.error(f"FTP上传错误: {e}")
+                    break
+                except Exception as e:
+                    self.pool.discard(ftp)
+                    ftp = None
+                    self.logger.error(f"FTP上传错误: {e}")
+                    break
+                
+                self.logger.success(f"文件上传成功: {filename}")
+                success = True
+                break
+            results.append(success)
+        
+        if ftp is not None:
+            self.pool.release(ftp)
+        return results
+    
+    def upload_stream(self, stream, filename):
+        """边读取边上传，数据只能读取一次，失败时不重试"""
         if not self.working_directory:
             self.logger.error("未设置有效的工作目录，无法上传文件")
             return False
-            
+        
+        self.logger.info(f"开始流式上传图片: {filename}")
         try:
-            self.logger.info(f"开始上传图片: {filename}")
-            ftp = FTP(self.host)
-            ftp.encoding = 'gbk'  # 设置FTP服务器编码为GBK
-            self.logger.info(f"正在连接FTP服务器: {self.host}")
-            ftp.login(user=self.user, passwd=self.password)
-            self.logger.info("FTP登录成功")
-            
-            # 切换到目标目录
-            self.logger.info(f"切换到目录: {self.working_directory}")
-            ftp.cwd(self.working_directory)
-            
-            # 上传文件
-            self.logger.info(f"开始上传文件: {filename}")
-            ftp.storbinary(f'STOR {filename}', image_data)
-            self.logger.success(f"文件上传成功: {filename}")
-            
-            ftp.quit()
-            return True
+            ftp = self.pool.acquire()
+        except Exception as e:
+            self.logger.error(f"FTP连接错误: {e}")
+            return False
+        
+        try:
+            with self.limiter.transfer(BandwidthLimiter.INTERACTIVE) if self.limiter else contextlib.nullcontext():
+                seconds, sent = self._store(ftp, filename, stream, BandwidthLimiter.INTERACTIVE, resume=False)
+            if self.metrics:
+                self.metrics.record_transfer(sent, seconds)
         except Exception as e:
-            self.logger.error(f"FTP上传错误: {e}")
+            self.pool.discard(ftp)
+            # 重试时用STOR从头覆盖服务器上残留的临时文件
+            self.partial_uploads.discard(filename)
+            self.logger.error(f"FTP流式上传错误: {e}")
             return False
+        
+        self.pool.release(ftp)
+        self.logger.success(f"文件上传成功: {filename}")
+        return True
+    
+    def revalidate(self):
+        """创建并返回验证缓存目录的线程"""
+        self.revalidate_thread = FTPRevalidateThread(self)
+        return self.revalidate_thread
+    
+    def close(self):
+        """关闭所有保持的FTP会话"""
+        self.pool.close()
+
+class SFTPDestination:
+    """通过SFTP上传到指定目录（需要安装paramiko），保持一个SSH会话"""
+    def __init__(self, name, host, user, password, directory, logger, port=22, timeout=30):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.directory = directory
+        self.logger = logger
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.transport = None
+        self.sftp = None
+        # 上传限速器，为None时不限速
+        self.limiter = None
+        # 已确认存在的子目录
+        self.known_directories = set()
+    
+    def is_ready(self):
+        return True
+    
+    def _ensure_directory(self, directory):
+        if not directory or directory in self.known_directories:
+            return
+        path = ""
+        for part in directory.split("/"):
+            path = posixpath.join(path, part)
+            try:
+                self.sftp.stat(path)
+            except IOError:
+                self.sftp.mkdir(path)
+        self.known_directories.add(directory)
+    
+    def connect(self):
+        import paramiko
+        self.logger.info(f"[{self.name}] 正在连接SFTP服务器: {self.host}")
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        transport = paramiko.Transport(sock)
+        try:
+            transport.connect(username=self.user, password=self.password)
+            sftp = paramiko.SFTPClient.from_transport(transport)
+            sftp.get_channel().settimeout(self.timeout)
+            sftp.chdir(self.directory)
+        except Exception:
+            transport.close()
+            raise
+        self.transport = transport
+        self.sftp = sftp
+    
+    def upload_batch(self, files, priority=BandwidthLimiter.INTERACTIVE):
+        """依次上传多个文件，会话断开时重新连接并重试一次"""
+        results = []
+        with self.lock, self.limiter.transfer(priority) if self.limiter else contextlib.nullcontext():
+            for filename, data in files:
+                success = False
+                for attempt in range(2):
+                    try:
+                        if self.sftp is None:
+                            self.connect()
+                        data.seek(0)
+                        self._ensure_directory(posixpath.dirname(filename))
+                        self.sftp.putfo(ThrottledReader(data, self.limiter, priority) if self.limiter else data, filename)
+                        self.logger.success(f"[{self.name}] 文件上传成功: {filename}")
+                        success = True
+                        break
+                    except ImportError:
+                        self.logger.error(f"[{self.name}] SFTP上传需要安装paramiko")
+                        return [False] * len(files)
+                    except Exception as e:
+                        self._close()
+                        if attempt == 0:
+                            self.logger.warning(f"[{self.name}] SFTP会话出错，重新连接: {e}")
+                            continue
+                        self.logger.error(f"[{self.name}] SFTP上传错误: {e}")
+                results.append(success)
+        return results
+    
+    def _close(self):
+        if self.transport:
+            self.transport.close()
+        self.transport = None
+        self.sftp = None
+        self.known_directories.clear()
+    
+    def close(self):
+        with self.lock:
+            self._close()
+
+class LocalDirectoryDestination:
+    """复制到本地目录，如已挂载的NAS共享目录"""
+    def __init__(self, name, directory, logger):
+        self.name = name
+        self.directory = directory
+        self.logger = logger
+    
+    def is_ready(self):
+        # 共享目录未挂载时先不上传，截图保留在本地缓存中
+        return os.path.isdir(self.directory)
+    
+    def upload_batch(self, files, priority=BandwidthLimiter.INTERACTIVE):
+        # 本地复制不经过外网链路，不限速
+        results = []
+        for filename, data in files:
+            path = os.path.join(self.directory, *filename.split("/"))
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                data.seek(0)
+                with open(path + ".tmp", "wb") as f:
+                    shutil.copyfileobj(data, f)
+                os.replace(path + ".tmp", path)
+                self.logger.success(f"[{self.name}] 文件已复制到: {path}")
+                results.append(True)
+            except OSError as e:
+                self.logger.error(f"[{self.name}] 复制文件失败: {e}")
+                results.append(False)
+        return results
+    
+    def close(self):
+        pass
+
+def create_destination(spec, logger, metrics=None, blocksize=64 * 1024, engine=None, concurrency=4):
+    """按配置创建附加的上传目标，指定engine（AsyncFTPEngine）时FTP目标使用asyncio上传
+    spec: {"name", "type": ftp/sftp/local, "host", "port", "user", "password", "directory", "encoding"}"""
+    kind = spec.get("type", "ftp")
+    name = spec["name"]
+    if kind == "ftp":
+        if engine:
+            from screenshot_ftp_async import AsyncFTPUploader
+            destination = AsyncFTPUploader(engine, spec["host"], spec["user"], spec["password"], logger, metrics,
+                                           blocksize, spec.get("port", 21), name, concurrency)
+        else:
+            destination = FTPUploader(spec["host"], spec["user"], spec["password"], logger, metrics, blocksize,
+                                      spec.get("port", 21), name)
+        destination.pool.encoding = spec.get("encoding", "gbk")
+        destination.working_directory = spec["directory"]
+        return destination
+    if kind == "sftp":
+        return SFTPDestination(name, spec["host"], spec["user"], spec["password"], spec["directory"], logger,
+                               spec.get("port", 22))
+    if kind == "local":
+        return LocalDirectoryDestination(name, spec["directory"], logger)
+    raise ValueError(f"未知的上传目标类型: {kind}")
 
 class KeyboardListener(QObject):
-    screenshot_taken = pyqtSignal()
+    screenshot_taken = pyqtSignal(float)  # 按键时间 (time.monotonic)
     
     def __init__(self, logger):
         super().__init__()
@@ -261,6 +1411,7 @@ class KeyboardListener(QObject):
         if not self.running:
             self.running = True
             self.logger.info("开始监听Print Screen键")
+            from pynput import keyboard
             self.listener = keyboard.Listener(on_press=self.on_press)
             self.listener.start()
     
@@ -273,357 +1424,1798 @@ class KeyboardListener(QObject):
     
     def on_press(self, key):
         if hasattr(key, 'name') and key.name == 'print_screen':
+            key_time = time.monotonic()
             self.logger.info("检测到Print Screen键被按下")
-            self.screenshot_taken.emit()
+            self.screenshot_taken.emit(key_time)
+
+# 图像编码方案
+# format: PIL保存格式，extension: 上传文件扩展名，params: 传给Image.save的参数
+# quantize: 编码前量化为调色板图像的颜色数，适合界面类截图
+ENCODER_PROFILES = {
+    "default": {"format": "PNG", "extension": "png", "params": {}},
+    # 最低压缩级别，编码耗时约为默认的一半，体积基本不变
+    "fast": {"format": "PNG", "extension": "png", "params": {"compress_level": 1}},
+    # 无损WebP，界面截图体积通常只有PNG的几分之一
+    "small": {"format": "WEBP", "extension": "webp", "params": {"lossless": True, "quality": 50, "method": 4}},
+    "palette": {"format": "PNG", "extension": "png", "params": {"compress_level": 6}, "quantize": 256},
+    "webp": {"format": "WEBP", "extension": "webp", "params": {"quality": 80, "method": 4}},
+    "jpeg": {"format": "JPEG", "extension": "jpg", "params": {"quality": 85}},
+    # 只保留活动窗口并缩小到1080p以内，适合只需看清界面内容的场合
+    "review": {"format": "PNG", "extension": "png", "params": {},
+               "preprocess": {"max_edge": 1920, "crop": "window", "strip_alpha": True}},
+}
+
+def active_window_rect():
+    """返回当前活动窗口在虚拟桌面上的区域 (x, y, w, h)，无法获取时返回None"""
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            import ctypes.wintypes
+            hwnd = ctypes.windll.user32.GetForegroundWindow()
+            rect = ctypes.wintypes.RECT()
+            if not hwnd or not ctypes.windll.user32.GetWindowRect(hwnd, ctypes.byref(rect)):
+                return None
+            return rect.left, rect.top, rect.right - rect.left, rect.bottom - rect.top
+        
+        # X11下通过python-xlib读取 _NET_ACTIVE_WINDOW（pynput在Linux下已依赖python-xlib）
+        from Xlib import X, display
+        xdisplay = display.Display()
+        try:
+            root = xdisplay.screen().root
+            active = root.get_full_property(xdisplay.intern_atom("_NET_ACTIVE_WINDOW"), X.AnyPropertyType)
+            if not active or not active.value or not active.value[0]:
+                return None
+            window = xdisplay.create_resource_object("window", active.value[0])
+            geometry = window.get_geometry()
+            position = root.translate_coords(window, 0, 0)
+            return position.x, position.y, geometry.width, geometry.height
+        finally:
+            xdisplay.close()
+    except Exception:
+        return None
+
+class ImagePreprocessor:
+    """编码前的图像预处理：去掉透明通道、裁剪到活动窗口或变化区域、限制最长边"""
+    def __init__(self, max_edge=None, crop=None, strip_alpha=False, change_margin=16):
+        # max_edge: 最长边像素数上限, crop: None/window/changed, strip_alpha: 去掉透明通道
+        if crop not in (None, "window", "changed"):
+            raise ValueError(f"未知的裁剪方式: {crop}")
+        self.max_edge = max_edge
+        self.crop = crop
+        self.strip_alpha = strip_alpha
+        self.change_margin = change_margin
+        # 上一张截图，用于计算变化区域
+        self.previous = None
+    
+    @property
+    def enabled(self):
+        return bool(self.max_edge or self.crop or self.strip_alpha)
+    
+    def process(self, image):
+        """在原始像素上处理，返回处理后的图像（未处理时返回原图像）"""
+        from PIL import Image, ImageChops
+        crop_box = image.info.get("crop_box")
+        if self.strip_alpha and "A" in image.getbands():
+            image = image.convert("RGB")
+        
+        if self.crop == "window" and crop_box:
+            image = image.crop(crop_box)
+        elif self.crop == "changed":
+            previous, self.previous = self.previous, image
+            if previous is not None and previous.size == image.size and previous.mode == image.mode:
+                box = ImageChops.difference(previous, image).getbbox()
+                if box:
+                    margin = self.change_margin
+                    image = image.crop((max(0, box[0] - margin), max(0, box[1] - margin),
+                                        min(image.width, box[2] + margin), min(image.height, box[3] + margin)))
+        
+        if self.max_edge and max(image.size) > self.max_edge:
+            scale = self.max_edge / max(image.size)
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            # 先按整数倍快速缩小，再做双线性插值
+            image = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+        return image
+
+# 多进程PNG编码工作进程中已打开的共享内存: 名称 -> SharedMemory
+_strip_memory = {}
+
+def _warm_up():
+    """进程池预热任务，只为提前启动工作进程并完成模块导入"""
+    return os.getpid()
+
+def _compress_png_strip(memory_name, row_bytes, first_row, last_row, level, final):
+    """在工作进程中压缩共享内存中的一段扫描行（过滤类型0）
+    输出为原始deflate数据，非最后一段以SYNC_FLUSH结束以便直接拼接，返回 (压缩数据, adler32, 未压缩长度)"""
+    from multiprocessing import shared_memory
+    memory = _strip_memory.get(memory_name)
+    if memory is None:
+        # 主进程换了更大的共享内存，关闭旧的
+        for old in _strip_memory.values():
+            old.close()
+        _strip_memory.clear()
+        memory = _strip_memory[memory_name] = shared_memory.SharedMemory(memory_name)
+    
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    adler = 1
+    parts = []
+    buffer = memory.buf
+    for start in range(first_row, last_row, 64):
+        rows = []
+        for y in range(start, min(last_row, start + 64)):
+            rows += (b"\x00", buffer[y * row_bytes:(y + 1) * row_bytes])
+        chunk = b"".join(rows)
+        del rows
+        adler = zlib.adler32(chunk, adler)
+        parts.append(compressor.compress(chunk))
+    del buffer
+    parts.append(compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH))
+    return b"".join(parts), adler, (last_row - first_row) * (row_bytes + 1)
+
+def adler32_combine(adler1, adler2, len2):
+    """合并两段数据的adler32校验值（与zlib的adler32_combine相同）"""
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1) % base
+    sum1 = (sum1 + (adler2 & 0xFFFF) + base - 1) % base
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + base - rem) % base
+    return sum1 | (sum2 << 16)
+
+def png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+class ParallelPNGEncoder:
+    """多进程PNG编码：原始像素复制到共享内存（不经过pickle），各进程压缩一段水平条带，
+    各段为同一个deflate流的连续片段，拼接为合法的IDAT序列"""
+    # 颜色模式 -> (PNG颜色类型, 每像素字节数)
+    COLOR_TYPES = {"L": (0, 1), "RGB": (2, 3), "RGBA": (6, 4)}
+    # zlib头部第二字节（压缩级别提示）
+    ZLIB_FLAGS = {0: 0x01, 1: 0x01, 2: 0x5E, 3: 0x5E, 4: 0x5E, 5: 0x5E, 6: 0x9C, 7: 0xDA, 8: 0xDA, 9: 0xDA}
+    # 小于此像素数的图像进程间调度的开销大于收益
+    MIN_PIXELS = 1000000
+    
+    def __init__(self, workers, compress_level=6):
+        self.workers = workers
+        self.compress_level = compress_level
+        self.executor = None
+        self.memory = None
+        self.broken = False
+        self.lock = threading.Lock()
+    
+    def supports(self, image):
+        return (not self.broken and image.mode in self.COLOR_TYPES
+                and image.width * image.height >= self.MIN_PIXELS)
+    
+    def start(self):
+        """创建进程池并预热，第一次截图时无需再等待进程启动"""
+        if self.executor is not None:
+            return
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # spawn启动的进程不继承Qt和各线程的状态
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        for _ in range(self.workers):
+            self.executor.submit(_warm_up)
+    
+    def encode(self, image, fp):
+        """编码并写入文件对象；任一段失败（进程池不可用）时抛出异常，此时未写入任何数据"""
+        from multiprocessing import shared_memory
+        color_type, bands = self.COLOR_TYPES[image.mode]
+        width, height = image.size
+        row_bytes = width * bands
+        
+        with self.lock:
+            self.start()
+            data = image.tobytes()
+            if self.memory is None or self.memory.size < len(data):
+                self._release_memory()
+                self.memory = shared_memory.SharedMemory(create=True, size=len(data))
+            self.memory.buf[:len(data)] = data
+            del data
+            
+            strips = min(self.workers, height)
+            bounds = [height * i // strips for i in range(strips + 1)]
+            futures = []
+            try:
+                for i in range(strips):
+                    futures.append(self.executor.submit(_compress_png_strip, self.memory.name, row_bytes, bounds[i],
+                                                        bounds[i + 1], self.compress_level, i == strips - 1))
+                # 所有条带都压缩完成后才开始写入，失败时调用方可以改用其它方式重新编码
+                results = [future.result() for future in futures]
+            except Exception:
+                # 进程池已损坏，之后不再使用
+                self.broken = True
+                for future in futures:
+                    future.cancel()
+                raise
+            
+            fp.write(b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)))
+            adler = 1
+            for i, (compressed, strip_adler, length) in enumerate(results):
+                adler = adler32_combine(adler, strip_adler, length)
+                if i == 0:
+                    compressed = bytes((0x78, self.ZLIB_FLAGS[self.compress_level])) + compressed
+                if i == strips - 1:
+                    compressed += struct.pack(">I", adler)
+                fp.write(png_chunk(b"IDAT", compressed))
+            fp.write(png_chunk(b"IEND", b""))
+    
+    def _release_memory(self):
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+    
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+            self._release_memory()
+
+class ImageEncoder:
+    """按编码方案将PIL图像编码为待上传的字节流"""
+    def __init__(self, profile="default", quality=None, compress_level=None, optimize=None, quantize=None, workers=0):
+        if profile not in ENCODER_PROFILES:
+            raise ValueError(f"未知的编码方案: {profile}")
+        settings = ENCODER_PROFILES[profile]
+        self.profile = profile
+        self.format = settings["format"]
+        self.extension = settings["extension"]
+        self.params = dict(settings["params"])
+        self.quantize = settings.get("quantize")
+        self.preprocess = dict(settings.get("preprocess", {}))
+        
+        # 单独指定的参数覆盖方案中的默认值
+        if quality is not None:
+            self.params["quality"] = quality
+        if compress_level is not None:
+            self.params["compress_level"] = compress_level
+        if optimize is not None:
+            self.params["optimize"] = optimize
+        if quantize is not None:
+            self.quantize = quantize
+        # 解码后与原图逐像素相同（未量化的PNG）
+        self.lossless = self.format == "PNG" and not self.quantize
+        
+        # 多进程编码只用于未量化、未要求optimize的PNG
+        self.parallel = None
+        if workers and self.format == "PNG" and not self.quantize and not self.params.get("optimize"):
+            self.parallel = ParallelPNGEncoder(workers, self.params.get("compress_level", 6))
+    
+    def start(self):
+        """预先启动多进程编码的进程池"""
+        if self.parallel:
+            self.parallel.start()
+    
+    def close(self):
+        if self.parallel:
+            self.parallel.close()
+    
+    def prepare(self, image):
+        """转换为目标格式支持的颜色模式"""
+        from PIL import Image
+        if self.quantize:
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGB")
+            return image.quantize(colors=self.quantize, method=Image.FASTOCTREE)
+        if self.format == "JPEG" and image.mode != "RGB":
+            return image.convert("RGB")
+        if image.mode not in ("RGB", "RGBA", "L", "P"):
+            return image.convert("RGBA" if "A" in image.mode else "RGB")
+        return image
+    
+    def encode(self, image, fp):
+        """编码图像并写入文件对象"""
+        image = self.prepare(image)
+        if self.parallel and self.parallel.supports(image):
+            try:
+                self.parallel.encode(image, fp)
+                return
+            except Exception:
+                # 进程池不可用时改为在当前线程编码，此时尚未写入任何数据
+                pass
+        image.save(fp, format=self.format, **self.params)
+
+def qimage_to_pil(qimage):
+    """将QImage转换为PIL图像，不经过任何中间编码"""
+    from PyQt5.QtGui import QImage
+    from PIL import Image
+    
+    # QImage内存布局与PIL原始模式的对应关系（小端序）
+    # Format_RGB32/ARGB32/RGBX8888 需要PIL解包一次
+    # Format_RGBA8888 与PIL内部布局一致，可直接映射
+    raw_modes = {
+        QImage.Format_RGB32: ("RGB", "BGRX"),
+        QImage.Format_ARGB32: ("RGBA", "BGRA"),
+        QImage.Format_RGBX8888: ("RGB", "RGBX"),
+        QImage.Format_RGBA8888: ("RGBA", "RGBA"),
+    }
+    if qimage.format() not in raw_modes or sys.byteorder != 'little':
+        qimage = qimage.convertToFormat(QImage.Format_RGBA8888)
+    mode, raw_mode = raw_modes[qimage.format()]
+    
+    # 直接引用QImage的像素内存
+    bits = qimage.constBits()
+    bits.setsize(qimage.sizeInBytes())
+    size = (qimage.width(), qimage.height())
+    image = Image.frombuffer(mode, size, bits, "raw", raw_mode, qimage.bytesPerLine(), 1)
+    
+    if mode == raw_mode:
+        # PIL直接映射了QImage的内存，需保持QImage存活
+        image.qimage = qimage
+    return image
 
 # Linux系统截图处理
 def linux_grab_clipboard_image():
     """在Linux系统下从剪贴板获取图像"""
     try:
         # 尝试使用PyQt5获取剪贴板图像
-        clipboard = QApplication.clipboard()
+        from PyQt5.QtGui import QGuiApplication
+        clipboard = QGuiApplication.clipboard()
         mimeData = clipboard.mimeData()
         
         if mimeData.hasImage():
             qimage = clipboard.image()
-            buffer = QPixmap.fromImage(qimage).toImage()
-            
-            # 创建一个QPixmap并将缓冲区绘制到其上
-            pixmap = QPixmap.fromImage(buffer)
-            
-            # 转换为PIL图像
-            image_buffer = io.BytesIO()
-            pixmap.save(image_buffer, "PNG")
-            image_buffer.seek(0)
-            
-            return Image.open(image_buffer)
+            if qimage.isNull():
+                return None
+            return qimage_to_pil(qimage)
         else:
             return None
     except Exception as e:
         print(f"Linux剪贴板获取错误: {e}")
         return None
 
+class ClipboardCaptureBackend:
+    """从剪贴板读取系统截图工具生成的图像"""
+    name = "clipboard"
+    uses_clipboard = True
+    
+    def grab(self):
+        # 针对不同操作系统使用不同的截图方法
+        if IS_LINUX:
+            return linux_grab_clipboard_image()
+        from PIL import ImageGrab
+        return ImageGrab.grabclipboard()
+    
+    def origin(self, image):
+        """截图左上角在虚拟桌面上的坐标，只有整个桌面的截图才能确定"""
+        from PyQt5.QtGui import QGuiApplication
+        rect = QRect()
+        for screen in QGuiApplication.screens():
+            rect = rect.united(screen.geometry())
+        if image.size == (rect.width(), rect.height()):
+            return rect.x(), rect.y()
+        return None
+
+class ScreenCaptureBackend:
+    """通过 QScreen.grabWindow 直接抓取屏幕（X11下为XGetImage/XShm），不经过剪贴板"""
+    name = "screen"
+    uses_clipboard = False
+    
+    def __init__(self, region="all"):
+        # all: 所有显示器, primary: 主显示器, screen:N: 第N个显示器, x,y,w,h: 虚拟桌面上的矩形区域
+        self.region = region
+        # 最近一次抓取的区域
+        self.last_rect = None
+    
+    def target_rect(self, screens):
+        """计算要抓取的虚拟桌面区域"""
+        if self.region == "all":
+            rect = QRect()
+            for screen in screens:
+                rect = rect.united(screen.geometry())
+            return rect
+        if self.region == "primary":
+            from PyQt5.QtGui import QGuiApplication
+            return QGuiApplication.primaryScreen().geometry()
+        if self.region.startswith("screen:"):
+            return screens[int(self.region.split(":", 1)[1])].geometry()
+        x, y, w, h = (int(v) for v in self.region.split(","))
+        return QRect(x, y, w, h)
+    
+    def grab(self):
+        from PyQt5.QtGui import QGuiApplication, QImage, QPainter
+        screens = QGuiApplication.screens()
+        if not screens:
+            return None
+        rect = self.target_rect(screens)
+        self.last_rect = rect
+        
+        # 依次抓取与目标区域相交的每个显示器，grabWindow的坐标相对于该显示器
+        parts = []
+        for screen in screens:
+            geometry = screen.geometry()
+            area = geometry.intersected(rect)
+            if area.isEmpty():
+                continue
+            pixmap = screen.grabWindow(0, area.x() - geometry.x(), area.y() - geometry.y(), area.width(), area.height())
+            if pixmap.isNull():
+                return None
+            parts.append((area, pixmap))
+        if not parts:
+            return None
+        
+        # 区域只在一个显示器上时无需拼接
+        if len(parts) == 1 and parts[0][0] == rect:
+            return qimage_to_pil(parts[0][1].toImage())
+        
+        canvas = QImage(rect.size(), QImage.Format_RGB32)
+        canvas.fill(Qt.black)
+        painter = QPainter(canvas)
+        for area, pixmap in parts:
+            painter.drawPixmap(area.topLeft() - rect.topLeft(), pixmap)
+        painter.end()
+        return qimage_to_pil(canvas)
+    
+    def origin(self, image):
+        if self.last_rect is None:
+            return None
+        return self.last_rect.x(), self.last_rect.y()
+
+class ClipboardWatcher(QObject):
+    """监视剪贴板，按下截图键后一旦出现新图像立即通知读取"""
+    # 参数为截图的时间点字典
+    image_ready = pyqtSignal(dict)
+    timed_out = pyqtSignal(dict)
+    
+    def __init__(self, timeout=10.0, poll_interval=50):
+        super().__init__()
+        self.timeout = timeout
+        from PyQt5.QtGui import QGuiApplication
+        self.clipboard = QGuiApplication.clipboard()
+        self.clipboard.dataChanged.connect(self.on_data_changed)
+        
+        # 最近一次剪贴板出现图像的时间 (time.monotonic)
+        self.last_image_time = 0.0
+        # 等待新图像的截图请求，按按键顺序排列
+        self.waiting = []
+        
+        # Windows下额外轮询剪贴板序列号，防止漏掉变化通知
+        self.sequence_number = None
+        self.poll_timer = None
+        if sys.platform == 'win32':
+            import ctypes
+            self.get_sequence_number = ctypes.windll.user32.GetClipboardSequenceNumber
+            self.sequence_number = self.get_sequence_number()
+            self.poll_timer = QTimer(self)
+            self.poll_timer.setInterval(poll_interval)
+            self.poll_timer.timeout.connect(self.poll)
+    
+    def request(self, marks):
+        """按键后请求读取新截图，已出现新图像时立即通知"""
+        key_time = marks.get("key_event", time.monotonic())
+        if self.last_image_time >= key_time:
+            marks["clipboard_ready"] = self.last_image_time
+            QTimer.singleShot(0, lambda: self.image_ready.emit(marks))
+            return
+        
+        self.waiting.append(marks)
+        QTimer.singleShot(int(self.timeout * 1000), lambda: self.expire(marks))
+        if self.poll_timer and not self.poll_timer.isActive():
+            self.poll_timer.start()
+    
+    def on_data_changed(self):
+        mime_data = self.clipboard.mimeData()
+        if mime_data is None or not mime_data.hasImage():
+            return
+        self.last_image_time = time.monotonic()
+        
+        # 每次变化只对应最早的一次按键
+        if self.waiting:
+            marks = self.waiting.pop(0)
+            marks["clipboard_ready"] = self.last_image_time
+            self.image_ready.emit(marks)
+        if not self.waiting and self.poll_timer:
+            self.poll_timer.stop()
+    
+    def poll(self):
+        sequence_number = self.get_sequence_number()
+        if sequence_number != self.sequence_number:
+            self.sequence_number = sequence_number
+            self.on_data_changed()
+    
+    def expire(self, marks):
+        """等待超时，剪贴板中仍是旧内容"""
+        if any(waiting is marks for waiting in self.waiting):
+            self.waiting = [waiting for waiting in self.waiting if waiting is not marks]
+            self.timed_out.emit(marks)
+
+_host_tag = None
+
+def host_tag():
+    """用于文件名的主机名，只保留ASCII字母、数字和连字符"""
+    global _host_tag
+    if _host_tag is None:
+        _host_tag = "".join(c for c in socket.gethostname() if c.isascii() and (c.isalnum() or c == "-")) or "host"
+    return _host_tag
+
+def remote_path(layout, filename, created=None):
+    """文件在上传目录下的相对路径，layout为空时不分子目录
+    created: 截图时间 (time.time())，为None时使用当前时间"""
+    if not layout:
+        return filename
+    date = datetime.fromtimestamp(created) if created else datetime.now()
+    directory = layout.format(year=f"{date:%Y}", month=f"{date:%m}", day=f"{date:%d}", host=host_tag())
+    return posixpath.join(directory.strip("/"), filename)
+
+def check_remote_layout(layout):
+    """检查上传目录格式，含有未知字段或格式错误时抛出ValueError"""
+    try:
+        remote_path(layout, "x")
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f"上传目录格式无效: {layout} (可用字段: year, month, day, host; {e!r})") from None
+
 class ScreenshotManager:
-    def __init__(self, ftp_uploader, logger):
+    def __init__(self, ftp_uploader, logger, encoder=None, capture_backend=None, preprocessor=None):
         self.ftp_uploader = ftp_uploader
         self.logger = logger
+        self.encoder = encoder or ImageEncoder()
+        # 未指定时使用编码方案中的预处理设置
+        self.preprocessor = preprocessor or ImagePreprocessor(**self.encoder.preprocess)
+        self.capture_backend = capture_backend or ClipboardCaptureBackend()
+        # 直接截屏失败时改用剪贴板
+        self.clipboard_backend = ClipboardCaptureBackend()
+        # 增量编码器（screenshot_ftp_delta.TileDeltaEncoder），为None时每张截图完整上传
+        self.tile_delta = None
+        self.filename_pattern = DEFAULT_CONFIG["filename_pattern"]
+        self.sequence = 0
+        self.sequence_lock = threading.Lock()
     
-    def capture_and_upload(self):
+    def grab_image(self, backend=None):
+        """获取截图，必须在GUI线程中调用"""
+        backend = backend or self.capture_backend
+        from PIL import Image
         try:
-            # 等待系统完成截图并复制到剪贴板
-            self.logger.info("等待系统完成截图 (0.5秒)")
-            time.sleep(0.5)
-            
-            # 从剪贴板获取图像
-            self.logger.info("尝试从剪贴板获取图像")
-            
-            # 针对不同操作系统使用不同的截图方法
-            if IS_LINUX:
-                image = linux_grab_clipboard_image()
+            if backend.uses_clipboard:
+                self.logger.info("尝试从剪贴板获取图像")
             else:
-                image = ImageGrab.grabclipboard()
+                self.logger.info("直接抓取屏幕图像")
+            image = backend.grab()
             
             if image:
                 if isinstance(image, Image.Image):
                     # 获取图像尺寸
                     width, height = image.size
                     self.logger.info(f"成功获取截图，尺寸: {width}x{height}")
-                    
-                    # 生成文件名
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    filename = f"screenshot_{timestamp}.png"
-                    
-                    # 转换图像为字节流
-                    self.logger.info("准备图像数据用于上传")
-                    img_byte_arr = io.BytesIO()
-                    image.save(img_byte_arr, format='PNG')
-                    img_byte_arr.seek(0)
-                    
-                    # 上传到FTP
-                    self.logger.info("开始上传图像到FTP")
-                    success = self.ftp_uploader.upload_image(img_byte_arr, filename)
-                    if success:
-                        self.logger.success(f"截图上传成功: {filename}")
-                    return success, filename
+                    if self.preprocessor.crop == "window":
+                        self.mark_active_window(image, backend)
+                    return image, None
                 else:
                     self.logger.error(f"剪贴板中的内容不是图像，而是: {type(image)}")
-                    return False, "剪贴板中的内容不是图像"
+                    return None, "剪贴板中的内容不是图像"
             else:
-                self.logger.error("剪贴板中没有图像")
-                return False, "剪贴板中没有图像"
+                if backend.uses_clipboard:
+                    self.logger.error("剪贴板中没有图像")
+                    return None, "剪贴板中没有图像"
+                self.logger.error("无法抓取屏幕图像")
+                return None, "无法抓取屏幕图像"
         except Exception as e:
             self.logger.error(f"截图处理错误: {e}")
-            return False, str(e)
-
-class LogWidget(QTextEdit):
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.setReadOnly(True)
-        self.setLineWrapMode(QTextEdit.WidgetWidth)
-        self.setStyleSheet("""
-            QTextEdit {
-                background-color: #f5f5f5;
-                color: #333333;
-                font-family: Monospace;
-                font-size: 9pt;
-                border: 1px solid #cccccc;
-            }
-        """)
-    
-    def append_log(self, message, level="info"):
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        
-        if level == "error":
-            html = f'<p style="margin:0;"><span style="color:#888888;">[{timestamp}]</span> <span style="color:#ff0000;font-weight:bold;">[错误]</span> {message}</p>'
-        elif level == "warning":
-            html = f'<p style="margin:0;"><span style="color:#888888;">[{timestamp}]</span> <span style="color:#ff9900;">[警告]</span> {message}</p>'
-        elif level == "success":
-            html = f'<p style="margin:0;"><span style="color:#888888;">[{timestamp}]</span> <span style="color:#009900;">[成功]</span> {message}</p>'
-        else:  # info
-            html = f'<p style="margin:0;"><span style="color:#888888;">[{timestamp}]</span> <span style="color:#0066cc;">[信息]</span> {message}</p>'
-        
-        self.append(html)
-        cursor = self.textCursor()
-        cursor.movePosition(QTextCursor.End)
-        self.setTextCursor(cursor)
-
-class MainWindow(QMainWindow):
+            return None, str(e)
+    
+    def mark_active_window(self, image, backend):
+        """截图时记录活动窗口在图像中的区域，编码前据此裁剪"""
+        rect = active_window_rect()
+        origin = backend.origin(image) if hasattr(backend, "origin") else None
+        if rect is None or origin is None:
+            self.logger.info("无法确定活动窗口位置，不裁剪")
+            return
+        x, y, w, h = rect
+        left, top = max(0, x - origin[0]), max(0, y - origin[1])
+        right, bottom = min(image.width, x - origin[0] + w), min(image.height, y - origin[1] + h)
+        if right > left and bottom > top:
+            image.info["crop_box"] = (left, top, right, bottom)
+    
+    def preprocess(self, image):
+        """编码前的预处理，可在后台线程中调用"""
+        if not self.preprocessor.enabled:
+            return image
+        return self.preprocessor.process(image)
+    
+    def make_filename(self, extension):
+        """按文件名格式生成上传文件名，带毫秒、主机名和序号，同一秒内的多张截图不会重名"""
+        now = datetime.now()
+        with self.sequence_lock:
+            self.sequence = self.sequence % 9999 + 1
+            sequence = self.sequence
+        name = self.filename_pattern.format(time=now, ms=now.microsecond // 1000, host=host_tag(), seq=sequence)
+        return f"{name}.{extension}"
+    
+    def encode_image(self, image, filename=None):
+        """将图像编码为待上传的字节流，可在后台线程中调用"""
+        if self.tile_delta:
+            return self.tile_delta.encode(image, self, filename)
+        
+        # 生成文件名
+        filename = filename or self.make_filename(self.encoder.extension)
+        
+        # 转换图像为字节流
+        self.logger.info(f"准备图像数据用于上传 (编码方案: {self.encoder.profile})")
+        img_byte_arr = io.BytesIO()
+        self.encoder.encode(image, img_byte_arr)
+        img_byte_arr.seek(0)
+        return filename, img_byte_arr
+
+class DuplicateCache:
+    """最近截图的像素哈希缓存，用于跳过内容完全相同的截图，按LRU淘汰"""
+    # 计算哈希时每次读取的行数，避免整张截图再复制一份
+    HASH_ROWS = 64
+    
+    def __init__(self, capacity=64, path=None):
+        self.capacity = capacity
+        self.path = path
+        self.lock = threading.Lock()
+        # 哈希 -> 首次上传时的文件名
+        self.entries = OrderedDict()
+        if path:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.entries = OrderedDict(json.load(f))
+            except Exception:
+                self.entries = OrderedDict()
+    
+    @classmethod
+    def hash_image(cls, image):
+        """对原始像素数据计算哈希，按行分段读取，不额外复制整帧"""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}".encode("ascii"))
+        for top in range(0, image.height, cls.HASH_ROWS):
+            digest.update(image.crop((0, top, image.width, min(image.height, top + cls.HASH_ROWS))).tobytes())
+        return digest.hexdigest()
+    
+    def lookup(self, key):
+        """返回相同截图的文件名，没有时返回None"""
+        with self.lock:
+            filename = self.entries.get(key)
+            if filename is not None:
+                self.entries.move_to_end(key)
+            return filename
+    
+    def add(self, key, filename):
+        with self.lock:
+            self.entries[key] = filename
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            if self.path:
+                try:
+                    write_file_atomic(self.path, json.dumps(self.entries).encode("utf-8"))
+                except OSError:
+                    pass
+
+class UploadSpool:
+    """本地上传缓存：截图编码后先写入磁盘，所有上传目标都成功后才删除"""
+    INDEX_FILE = "index.json"
+    
+    def __init__(self, directory, logger, targets=("primary",)):
+        self.directory = directory
+        self.logger = logger
+        self.targets = list(targets)
+        self.index_path = os.path.join(directory, self.INDEX_FILE)
+        self.condition = threading.Condition()
+        self.closed = False
+        
+        # 文件名 -> {"created", "targets": {目标: {"status", "attempts", "last_error"}}}，按加入顺序排列
+        # status: pending 等待上传, uploading 上传中, done 已上传
+        self.items = {}
+        # 本次运行中新加入的截图，首次上传时优先于缓存积压
+        self.fresh = set()
+        self.load()
+    
+    def load(self):
+        """读取索引，恢复上次未完成的上传"""
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.items = json.load(f)
+        except FileNotFoundError:
+            self.items = {}
+        except Exception as e:
+            self.logger.warning(f"上传缓存索引损坏，将重新扫描缓存目录: {e}")
+            self.items = {}
+        
+        for name, item in list(self.items.items()):
+            if "targets" not in item:
+                # 旧版索引只有一个上传目标
+                state = {"status": "pending", "attempts": item.get("attempts", 0), "last_error": item.get("last_error", "")}
+                item = {"created": item.get("created", time.time()), "targets": {self.targets[0]: state}}
+                self.items[name] = item
+            # 已从配置中删除的目标不再上传；上次退出时正在上传的重新排队
+            item["targets"] = {target: state for target, state in item["targets"].items() if target in self.targets}
+            for state in item["targets"].values():
+                if state["status"] == "uploading":
+                    state["status"] = "pending"
+        
+        # 数据已落盘但索引未来得及更新的文件同样加入队列
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+            elif name != self.INDEX_FILE and name not in self.items:
+                self.items[name] = self.new_item()
+        
+        # 丢弃数据文件已不存在或已没有待上传目标的条目
+        for name in list(self.items):
+            if not os.path.exists(self.path(name)) or self.is_done(self.items[name]):
+                self.remove(name)
+        self.save()
+    
+    def new_item(self):
+        return {"created": time.time(),
+                "targets": {target: {"status": "pending", "attempts": 0, "last_error": ""} for target in self.targets}}
+    
+    @staticmethod
+    def is_done(item):
+        return all(state["status"] == "done" for state in item["targets"].values())
+    
+    def save(self):
+        write_file_atomic(self.index_path, json.dumps(self.items, ensure_ascii=False).encode("utf-8"))
+    
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+    
+    def put(self, filename, data):
+        """写入一个待上传的截图，所有上传目标共用同一份数据"""
+        write_file_atomic(self.path(filename), data.getbuffer())
+        with self.condition:
+            self.items[filename] = self.new_item()
+            self.fresh.add(filename)
+            self.save()
+            self.condition.notify_all()
+    
+    def is_interactive(self, filename, state):
+        """本次运行中新截图的首次上传"""
+        return filename in self.fresh and state["attempts"] == 0
+    
+    def pending(self, target):
+        """该目标待上传的 (文件名, 状态)，交互截图在前，其余按加入顺序"""
+        entries = [(filename, item["targets"][target]) for filename, item in self.items.items()
+                   if item["targets"].get(target, {}).get("status") == "pending"]
+        return sorted(entries, key=lambda entry: not self.is_interactive(*entry))
+    
+    def take(self, target, timeout=None):
+        """取出该目标下一个待上传条目并标记为上传中，超时返回None
+        返回的状态中 interactive 表示是否为交互截图, created 为截图写入缓存的时间"""
+        with self.condition:
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            while not self.closed:
+                for filename, state in self.pending(target):
+                    state["status"] = "uploading"
+                    return filename, dict(state, interactive=self.is_interactive(filename, state),
+                                          created=self.items[filename]["created"])
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return None
+    
+    def take_batch(self, target, max_items=1, max_bytes=None, window=0.0, timeout=None):
+        """取出该目标的一批待上传条目：取到第一个后，在window秒内继续收集同一优先级的后续截图，
+        直到达到max_items个或max_bytes字节，没有条目时返回空列表"""
+        first = self.take(target, timeout)
+        if first is None:
+            return []
+        batch = [first]
+        total = self.size(first[0])
+        deadline = time.monotonic() + window
+        with self.condition:
+            while len(batch) < max_items and not self.closed:
+                added = False
+                for filename, state in self.pending(target):
+                    if len(batch) >= max_items:
+                        break
+                    if self.is_interactive(filename, state) != first[1]["interactive"]:
+                        continue
+                    size = self.size(filename)
+                    if max_bytes is not None and total + size > max_bytes:
+                        return batch
+                    state["status"] = "uploading"
+                    batch.append((filename, dict(state, interactive=first[1]["interactive"],
+                                                 created=self.items[filename]["created"])))
+                    total += size
+                    added = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not added:
+                    self.condition.wait(remaining)
+        return batch
+    
+    def size(self, filename):
+        try:
+            return os.path.getsize(self.path(filename))
+        except OSError:
+            return 0
+    
+    def open(self, filename):
+        return open(self.path(filename), "rb")
+    
+    def complete(self, filename, target):
+        """该目标上传成功，所有目标都完成后删除缓存文件，返回是否已全部完成"""
+        with self.condition:
+            item = self.items.get(filename)
+            if item is None:
+                return True
+            if target in item["targets"]:
+                item["targets"][target]["status"] = "done"
+            if not self.is_done(item):
+                self.save()
+                return False
+            self.remove(filename)
+            self.save()
+            return True
+    
+    def drop(self, filename):
+        """缓存文件已无法读取，放弃所有目标的上传"""
+        with self.condition:
+            self.remove(filename)
+            self.save()
+    
+    def remove(self, filename):
+        self.items.pop(filename, None)
+        self.fresh.discard(filename)
+        try:
+            os.remove(self.path(filename))
+        except FileNotFoundError:
+            pass
+    
+    def status(self, filename, target):
+        """该目标的上传状态，条目已删除时返回None"""
+        with self.condition:
+            item = self.items.get(filename)
+            if item is None or target not in item["targets"]:
+                return None
+            return item["targets"][target]["status"]
+    
+    def fail(self, filename, target, error):
+        """该目标上传失败，放回队尾等待重试，返回该目标累计失败次数；条目已被删除时返回0"""
+        with self.condition:
+            # 其它目标可能已放弃该截图（缓存文件无法读取）
+            item = self.items.get(filename)
+            if item is None or target not in item["targets"]:
+                return 0
+            # 移到队尾
+            self.items[filename] = self.items.pop(filename)
+            state = item["targets"][target]
+            state["status"] = "pending"
+            state["attempts"] += 1
+            state["last_error"] = error
+            self.save()
+            self.condition.notify_all()
+            return state["attempts"]
+    
+    def pending_count(self, target=None):
+        """未上传完成的截图数，指定目标时只统计该目标"""
+        with self.condition:
+            if target is None:
+                return len(self.items)
+            return sum(1 for item in self.items.values()
+                       if item["targets"].get(target, {}).get("status", "done") != "done")
+    
+    def close(self):
+        """唤醒所有等待中的线程"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class CaptureJob:
+    """一次截图在上传流水线中的数据"""
+    def __init__(self, image, marks=None):
+        self.image = image
+        self.filename = None
+        self.data = None
+        # 各阶段的时间点 (time.monotonic)，用于统计耗时
+        self.marks = marks or {}
+        # 在内存预算中占用的字节数；溢出到磁盘时为 (路径, 模式, 尺寸, info)；被丢弃时dropped为True
+        self.memory = 0
+        self.spill = None
+        self.dropped = False
+
+class FrameBudget:
+    """排队等待编码的截图及编码结果的内存预算，超出时按策略处理:
+    spill 将最早的截图写入本地临时目录（由溢出线程写入，不阻塞提交截图的GUI线程），编码前通过mmap读回，
+    等待写入的截图也超出预算时说明磁盘跟不上，丢弃新截图;
+    drop_oldest 丢弃最早的截图;
+    coalesce 不论是否超出预算都只保留最新的截图; drop_newest 丢弃新截图"""
+    POLICIES = ("spill", "drop_oldest", "coalesce", "drop_newest")
+    # 溢出时每次写入的行数，避免整张截图再复制一份
+    SPILL_ROWS = 256
+    
+    def __init__(self, limit, logger, policy="spill", directory=None, metrics=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"未知的内存策略: {policy}")
+        if policy == "spill" and not directory:
+            raise ValueError("spill 策略需要指定溢出目录")
+        self.limit = limit
+        self.logger = logger
+        self.policy = policy
+        self.directory = directory
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        # 还在内存中、尚未开始编码的截图，按提交顺序排列
+        self.queued = deque()
+        # 已选为溢出、等待写入磁盘的截图，以及正在写入的截图；预算中已按溢出计算
+        self.spill_queue = deque()
+        self.writing = None
+        # 等待写入和正在写入的字节数，超过预算时说明磁盘跟不上，不再接受新截图
+        self.pending_spill = 0
+        self.used = 0
+        self.spilled = 0
+        self.counter = 0
+        self.closed = False
+        self.spill_thread = None
+        if directory:
+            # 上次运行遗留的溢出文件已没有对应的队列，直接删除
+            for name in os.listdir(directory):
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(directory, name))
+        if policy == "spill":
+            self.spill_thread = threading.Thread(target=self._spill_worker, name="frame-spill", daemon=True)
+            self.spill_thread.start()
+    
+    @staticmethod
+    def frame_size(image):
+        """截图在内存中大约占用的字节数（PIL中RGB也按每像素4字节存储）"""
+        return image.width * image.height * (1 if image.mode in ("1", "L", "P") else 4)
+    
+    def admit(self, job):
+        """新截图加入预算，返回是否接受；超出预算时按策略腾出空间"""
+        job.memory = self.frame_size(job.image)
+        with self.lock:
+            if self.policy == "coalesce":
+                # 无论预算是否足够，只保留最新的截图；正在编码的截图不受影响
+                while self.queued:
+                    self._drop(self.queued.popleft())
+            while self.queued and self.used + job.memory > self.limit:
+                if self.policy == "drop_newest":
+                    break
+                if self.policy == "spill" and self.pending_spill + self.queued[0].memory > self.limit:
+                    break
+                oldest = self.queued.popleft()
+                if self.policy == "spill":
+                    # 这里只记账，写入磁盘由溢出线程完成；内存中最多还有一份预算大小的截图等待写入
+                    self.pending_spill += oldest.memory
+                    self.used -= oldest.memory
+                    self.spilled += oldest.memory
+                    self.spill_queue.append(oldest)
+                    self.condition.notify_all()
+                    continue
+                # 丢弃的截图在编码线程取到时直接跳过
+                self._drop(oldest)
+            
+            # 内存中没有其它截图时总是接受，保证预算小于一张截图时仍能上传
+            if self.used and self.used + job.memory > self.limit:
+                job.memory = 0
+                self._report()
+                return False
+            self.used += job.memory
+            self.queued.append(job)
+            self._report()
+        return True
+    
+    def _spill_worker(self):
+        """溢出线程：依次将选中的截图写入磁盘，写入失败时截图留在内存中"""
+        while True:
+            with self.condition:
+                while not self.spill_queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                job = self.writing = self.spill_queue.popleft()
+                image = job.image
+                memory = job.memory
+            
+            try:
+                spill = self._write(image)
+            except OSError as e:
+                spill = None
+                self.logger.error(f"截图写入溢出目录失败: {e}")
+            
+            with self.condition:
+                self.writing = None
+                self.pending_spill -= memory
+                if spill:
+                    job.spill, job.image = spill, None
+                else:
+                    self.spilled -= job.memory
+                    self.used += job.memory
+                self._report()
+                self.condition.notify_all()
+    
+    def _write(self, image):
+        """原始像素按行分段写入溢出文件，返回 (路径, 模式, 尺寸, info)"""
+        self.counter += 1
+        path = os.path.join(self.directory, f"frame_{os.getpid()}_{self.counter}.raw")
+        try:
+            with open(path, "wb") as f:
+                for top in range(0, image.height, self.SPILL_ROWS):
+                    f.write(image.crop((0, top, image.width, min(image.height, top + self.SPILL_ROWS))).tobytes())
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            raise
+        return path, image.mode, image.size, dict(image.info)
+    
+    def _drop(self, job):
+        job.dropped = True
+        job.image = None
+        self.used -= job.memory
+        job.memory = 0
+        if self.metrics:
+            self.metrics.record_dropped()
+    
+    def begin(self, job):
+        """编码线程开始处理截图前调用，需要时从溢出文件读回；截图已被丢弃时返回False"""
+        with self.condition:
+            if job.dropped:
+                return False
+            with contextlib.suppress(ValueError):
+                self.queued.remove(job)
+            if job in self.spill_queue:
+                # 还没有写入磁盘，直接使用内存中的截图
+                self.spill_queue.remove(job)
+                self.pending_spill -= job.memory
+                self.spilled -= job.memory
+                self.used += job.memory
+                self._report()
+            while self.writing is job:
+                self.condition.wait()
+            spill = job.spill
+        if not spill:
+            return True
+        
+        from PIL import Image
+        path, mode, size, info = spill
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            image = Image.frombytes(mode, size, data)
+        image.info.update(info)
+        os.remove(path)
+        with self.lock:
+            job.image, job.spill = image, None
+            self.spilled -= job.memory
+            self.used += job.memory
+            self._report()
+        return True
+    
+    def update(self, job, nbytes):
+        """编码完成后原图释放，改为计入编码结果的大小"""
+        with self.lock:
+            self.used += nbytes - job.memory
+            job.memory = nbytes
+            self._report()
+    
+    def release(self, job):
+        """截图已写入上传缓存、处理失败或未能加入队列，不再占用预算"""
+        with self.lock:
+            with contextlib.suppress(ValueError):
+                self.queued.remove(job)
+            if job.spill:
+                with contextlib.suppress(OSError):
+                    os.remove(job.spill[0])
+                self.spilled -= job.memory
+                job.spill = None
+            else:
+                self.used -= job.memory
+            job.memory = 0
+            self._report()
+    
+    def _report(self):
+        if self.metrics:
+            self.metrics.record_memory(self.used, self.spilled)
+    
+    def close(self):
+        """停止溢出线程"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.spill_thread:
+            self.spill_thread.join()
+            self.spill_thread = None
+
+class RetryState:
+    """一个上传目标的退避状态，由该目标的所有上传线程共用"""
     def __init__(self):
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.next_attempt = 0.0
+
+class UploadPipeline(QObject):
+    """截图处理流水线：GUI线程抓图，后台线程编码后写入本地缓存，再由各上传目标的线程取出上传"""
+    # 上传结果信号: 是否成功, 文件名或错误信息
+    upload_finished = pyqtSignal(bool, str)
+    
+    def __init__(self, screenshot_manager, ftp_uploader, spool, logger, max_pending=4, upload_workers=2,
+                 retry_base_delay=2.0, retry_max_delay=300.0, metrics=None,
+                 duplicate_cache=None, duplicate_policy="skip", stream_upload=False, stream_buffer_size=1024 * 1024,
+                 batch_window=0.0, batch_max_items=1, batch_max_bytes=None, batch_archive=False, destinations=None,
+                 remote_layout="", frame_budget=None):
         super().__init__()
+        self.screenshot_manager = screenshot_manager
+        self.ftp_uploader = ftp_uploader
+        # 上传目标: 主FTP服务器加上附加目标，每个目标有自己的上传线程和退避状态，互不影响
+        self.destinations = [ftp_uploader] + list(destinations or [])
+        self.retry_states = {destination.name: RetryState() for destination in self.destinations}
+        self.spool = spool
+        self.logger = logger
+        self.metrics = metrics
+        # 重复截图的处理方式: skip 跳过上传, pointer 只上传指向原文件的小文本, upload 照常上传
+        self.duplicate_cache = duplicate_cache
+        self.duplicate_policy = duplicate_policy
+        # 流式上传: 编码线程边编码边上传，不经过本地缓存，失败时再写入缓存重试
+        self.stream_upload = stream_upload
+        self.stream_buffer_size = stream_buffer_size
+        # 批量上传: 取到一个截图后在batch_window秒内继续收集，最多batch_max_items个/batch_max_bytes字节，
+        # 在同一个会话中依次上传；batch_archive时打包为一个zip文件
+        self.batch_window = batch_window
+        self.batch_max_items = batch_max_items
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_archive = batch_archive
+        # 上传目录下按截图日期分子目录的格式，字段无效时在这里报错，而不是在上传线程中
+        check_remote_layout(remote_layout)
+        self.remote_layout = remote_layout
+        self.upload_workers = upload_workers
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        # 排队截图的内存预算（FrameBudget），为None时只限制队列长度
+        self.frame_budget = frame_budget
+        
+        # 有界队列，避免连续截图无限堆积
+        self.encode_queue = queue.Queue(maxsize=max_pending)
+        self.encode_thread = None
+        self.upload_threads = []
+        self.stop_event = threading.Event()
+        
+        # 已写入缓存、尚未上传的截图的时间点
+        self.marks_lock = threading.Lock()
+        self.pending_marks = {}
+    
+    def start(self):
+        """启动编码线程和上传线程"""
+        if self.encode_thread:
+            return
+        self.stop_event.clear()
+        self.encode_thread = threading.Thread(target=self._encode_worker, name="encode-worker", daemon=True)
+        self.encode_thread.start()
+        # 主服务器使用upload_workers个线程，附加目标各一个线程
+        for destination in self.destinations:
+            workers = self.upload_workers if destination is self.ftp_uploader else 1
+            for i in range(workers):
+                thread = threading.Thread(target=self._upload_worker, args=(destination,),
+                                          name=f"upload-{destination.name}-{i}", daemon=True)
+                thread.start()
+                self.upload_threads.append(thread)
+    
+    def stop(self, timeout=5.0):
+        """通知后台线程退出，未上传的截图保留在本地缓存中"""
+        if not self.encode_thread:
+            return
+        try:
+            self.encode_queue.put(None, timeout=timeout)
+            self.encode_thread.join(timeout)
+        except queue.Full:
+            self.logger.warning("编码队列未能及时清空，放弃等待")
+        
+        self.stop_event.set()
+        if self.frame_budget:
+            self.frame_budget.close()
+        self.spool.close()
+        for thread in self.upload_threads:
+            thread.join(timeout)
+        self.encode_thread = None
+        self.upload_threads = []
+    
+    def submit(self, image, marks=None):
+        """提交截图到流水线，队列已满或超出内存预算时丢弃并返回False"""
+        job = CaptureJob(image, marks)
+        if self.frame_budget and not self.frame_budget.admit(job):
+            self.logger.warning("待处理截图占用的内存超出预算，本次截图已丢弃")
+            return False
+        try:
+            self.encode_queue.put_nowait(job)
+            return True
+        except queue.Full:
+            if self.frame_budget:
+                self.frame_budget.release(job)
+            self.logger.warning("待处理的截图过多，本次截图已丢弃")
+            return False
+    
+    def _encode_worker(self):
+        while True:
+            job = self.encode_queue.get()
+            if job is None:
+                break
+            try:
+                if self.frame_budget and not self.frame_budget.begin(job):
+                    # 超出内存预算时被较新的截图挤掉
+                    self.logger.warning("截图排队时超出内存预算，已丢弃")
+                    self.upload_finished.emit(False, "超出内存预算，截图已丢弃")
+                    continue
+                job.marks["encode_start"] = time.monotonic()
+                digest = None
+                if self.duplicate_cache and self.duplicate_policy != "upload":
+                    digest = self.duplicate_cache.hash_image(job.image)
+                    original = self.duplicate_cache.lookup(digest)
+                    if original:
+                        self._handle_duplicate(job, original)
+                        continue
+                
+                if self.screenshot_manager.preprocessor.enabled:
+                    start = time.monotonic()
+                    width, height = job.image.size
+                    job.image = self.screenshot_manager.preprocess(job.image)
+                    if self.metrics:
+                        self.metrics.record_preprocess(width * height, job.image.width * job.image.height,
+                                                       time.monotonic() - start)
+                
+                # 只有一个上传目标且不是增量上传时才能边编码边上传，否则写入缓存供各目标共用
+                if (self.stream_upload and len(self.destinations) == 1 and not self.screenshot_manager.tile_delta
+                        and self.ftp_uploader.working_directory):
+                    if self._stream_job(job):
+                        if digest:
+                            self.duplicate_cache.add(digest, job.filename)
+                        continue
+                    self.logger.warning("流式上传失败，改为写入本地缓存后重试")
+                
+                job.filename, job.data = self.screenshot_manager.encode_image(job.image, job.filename)
+                job.marks["encoded"] = time.monotonic()
+                job.image = None
+                if self.frame_budget:
+                    self.frame_budget.update(job, len(job.data.getbuffer()))
+                if digest:
+                    self.duplicate_cache.add(digest, job.filename)
+                with self.marks_lock:
+                    self.pending_marks[job.filename] = job.marks
+                self.spool.put(job.filename, job.data)
+            except Exception as e:
+                self.logger.error(f"图像编码错误: {e}")
+                self.upload_finished.emit(False, str(e))
+            finally:
+                job.data = None
+                if self.frame_budget:
+                    self.frame_budget.release(job)
+    
+    def _stream_job(self, job):
+        """编码输出直接送入FTP数据连接，返回是否上传成功"""
+        encoder = self.screenshot_manager.encoder
+        job.filename = self.screenshot_manager.make_filename(encoder.extension)
+        pipe = StreamPipe(self.stream_buffer_size)
+        result = {}
+        
+        def upload():
+            result["success"] = self.ftp_uploader.upload_stream(pipe, remote_path(self.remote_layout, job.filename))
+            if not result["success"]:
+                pipe.abort("上传失败")
+        
+        upload_thread = threading.Thread(target=upload, name="stream-upload", daemon=True)
+        upload_thread.start()
+        self.logger.info(f"边编码边上传 (编码方案: {encoder.profile})")
+        try:
+            encoder.encode(job.image, pipe)
+            job.marks["encoded"] = time.monotonic()
+            pipe.close()
+        except BrokenPipeError:
+            # 上传端已失败
+            pass
+        except Exception as e:
+            pipe.abort(f"编码失败: {e}")
+            self.logger.error(f"图像编码错误: {e}")
+        upload_thread.join()
+        
+        success = result.get("success", False)
+        if self.metrics:
+            self.metrics.record_upload(success, self.ftp_uploader.name)
+        if success:
+            job.image = None
+            job.marks["done"] = time.monotonic()
+            if self.metrics:
+                self.metrics.observe_marks(job.marks)
+            self.upload_finished.emit(True, job.filename)
+        return success
+    
+    def _handle_duplicate(self, job, original):
+        """截图与之前上传的完全相同，不再编码上传"""
+        job.image = None
+        if self.duplicate_policy == "pointer":
+            filename = self.screenshot_manager.make_filename("dup.txt")
+            self.logger.info(f"截图与 {original} 相同，只上传引用文件: {filename}")
+            self.spool.put(filename, io.BytesIO(f"duplicate-of: {original}\n".encode("utf-8")))
+        else:
+            self.logger.info(f"截图与 {original} 相同，跳过上传")
+            self.upload_finished.emit(True, f"{original}（内容相同，未重复上传）")
+    
+    def _wait_for_retry(self, state):
+        """等待退避时间结束，程序退出时返回False"""
+        with state.lock:
+            delay = state.next_attempt - time.monotonic()
+        if delay > 0:
+            return not self.stop_event.wait(delay)
+        return not self.stop_event.is_set()
+    
+    def _record_result(self, state, success):
+        with state.lock:
+            if success:
+                # 链路恢复后立即全速上传积压的截图
+                state.consecutive_failures = 0
+                state.next_attempt = 0.0
+                return 0.0
+            state.consecutive_failures += 1
+            delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** (state.consecutive_failures - 1))
+            delay *= random.uniform(0.5, 1.0)
+            state.next_attempt = time.monotonic() + delay
+            return delay
+    
+    def _upload_worker(self, destination):
+        state = self.retry_states[destination.name]
+        # 有多个上传目标时在日志中注明目标
+        label = f"[{destination.name}] " if len(self.destinations) > 1 else ""
+        while self._wait_for_retry(state):
+            # 工作目录确定之前不上传，缓存中的截图保留到下次
+            if not destination.is_ready():
+                self.stop_event.wait(1.0)
+                continue
+            
+            # 连续截图时收集一批，在同一个会话中依次上传
+            batch = self.spool.take_batch(destination.name, self.batch_max_items, self.batch_max_bytes,
+                                          self.batch_window, timeout=1.0)
+            if not batch:
+                continue
+            
+            try:
+                self._process_batch(destination, state, label, batch)
+            except Exception as e:
+                # 意外错误不能结束上传线程，尚未处理的截图放回队列等待重试
+                self.logger.error(f"{label}上传出错: {e}")
+                delay = self._record_result(state, False)
+                for filename, _ in batch:
+                    if self.spool.status(filename, destination.name) == "uploading":
+                        self.spool.fail(filename, destination.name, str(e))
+                self.logger.warning(f"{label}{len(batch)} 个截图保留在本地缓存，{delay:.0f}秒后重试")
+    
+    def _process_batch(self, destination, state, label, batch):
+        """上传取出的一批截图并记录每个截图的结果"""
+        with contextlib.ExitStack() as stack:
+            files = []
+            created = {}
+            for filename, item in batch:
+                created[filename] = item["created"]
+                try:
+                    files.append((filename, stack.enter_context(self.spool.open(filename))))
+                except OSError as e:
+                    self.logger.error(f"读取缓存文件失败: {e}")
+                    self.spool.drop(filename)
+                    self.upload_finished.emit(False, filename)
+            if not files:
+                return
+            
+            # 交互截图优先于缓存积压占用带宽
+            priority = BandwidthLimiter.INTERACTIVE if batch[0][1]["interactive"] else BandwidthLimiter.BACKLOG
+            # 上传目标上的路径按截图时间分目录
+            remote_files = [(remote_path(self.remote_layout, filename, created[filename]), data)
+                            for filename, data in files]
+            if len(files) == 1:
+                self.logger.info(f"{label}开始上传图像")
+                results = destination.upload_batch(remote_files, priority)
+            elif self.batch_archive:
+                results = self._upload_archive(destination, files, priority, created[files[0][0]])
+            else:
+                self.logger.info(f"{label}在同一会话中上传 {len(files)} 个截图")
+                results = destination.upload_batch(remote_files, priority)
         
-        # 创建日志组件
-        self.logger = Logger()
+        # 整批都失败时才认为链路有问题，进入退避
+        delay = self._record_result(state, any(results))
+        for (filename, _), success in zip(files, results):
+            if self.metrics:
+                self.metrics.record_upload(success, destination.name)
+            if success:
+                # 缓存文件在所有目标都完成后才删除，界面提示和耗时统计以主服务器为准
+                self.spool.complete(filename, destination.name)
+                if destination is not self.ftp_uploader:
+                    continue
+                with self.marks_lock:
+                    marks = self.pending_marks.pop(filename, None)
+                if marks and self.metrics:
+                    marks["done"] = time.monotonic()
+                    self.metrics.observe_marks(marks)
+                self.upload_finished.emit(True, filename)
+                continue
+            
+            attempts = self.spool.fail(filename, destination.name, "上传失败")
+            if not attempts:
+                continue
+            self.logger.warning(f"{label}截图已保存在本地缓存，{delay:.0f}秒后重试 (第{attempts}次失败): {filename}")
+            if attempts == 1:
+                self.upload_finished.emit(False, f"{label}{filename}")
+    
+    def _upload_archive(self, destination, files, priority=BandwidthLimiter.INTERACTIVE, created=None):
+        """将一批截图连同清单打包为一个zip文件上传，返回每个截图是否上传成功"""
+        import zipfile
+        archive_name = self.screenshot_manager.make_filename(f"batch{len(files)}.zip")
+        manifest = {"created": datetime.now().isoformat(timespec="seconds"), "files": []}
+        archive = io.BytesIO()
+        # 图像已经压缩过，zip中只存储不再压缩
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as zf:
+            for filename, data in files:
+                content = data.read()
+                zf.writestr(filename, content)
+                manifest["files"].append({"name": filename, "size": len(content),
+                                          "sha256": hashlib.sha256(content).hexdigest()})
+            zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
         
-        # FTP配置
-        self.ftp_host = "44.112.2.110"
-        self.ftp_user = "msk350500"
-        self.ftp_password = "qzxz@334"
+        self.logger.info(f"将 {len(files)} 个截图打包上传: {archive_name}")
+        success = destination.upload_batch([(remote_path(self.remote_layout, archive_name, created), archive)],
+                                           priority)[0]
+        return [success] * len(files)
+
+class UploaderService(QObject):
+    """截图上传服务：创建各组件并处理截图按键，界面窗口和后台模式共用"""
+    # 截图处理结果: 是否成功, 文件名或错误信息
+    capture_finished = pyqtSignal(bool, str)
+    # 监听状态变化
+    monitoring_changed = pyqtSignal(bool)
+    # 上传目录变化（确定、验证失效）
+    directory_changed = pyqtSignal()
+    # 目录探测结束: 是否成功, 信息
+    test_finished = pyqtSignal(bool, str)
+    
+    def __init__(self, config, logger):
+        super().__init__()
+        self.config = config
+        self.logger = logger
+        self.ftp_host = config["ftp_host"]
+        self.ftp_user = config["ftp_user"]
+        self.clipboard_timeout = config["clipboard_timeout"]
         
         # 初始化组件
-        self.ftp_uploader = FTPUploader(self.ftp_host, self.ftp_user, self.ftp_password, self.logger)
-        self.screenshot_manager = ScreenshotManager(self.ftp_uploader, self.logger)
+        self.metrics = PipelineMetrics()
+        self.metrics_exporter = MetricsExporter(self.metrics, config["metrics_file"], config["metrics_port"])
+        # asyncio上传时所有FTP目标共用一个事件循环线程
+        self.ftp_engine = None
+        if config["upload_engine"] == "asyncio":
+            from screenshot_ftp_async import AsyncFTPEngine, AsyncFTPUploader
+            self.ftp_engine = AsyncFTPEngine()
+            self.ftp_uploader = AsyncFTPUploader(self.ftp_engine, self.ftp_host, self.ftp_user, config["ftp_password"],
+                                                 self.logger, self.metrics, config["upload_blocksize"],
+                                                 config["ftp_port"], concurrency=config["upload_concurrency"])
+        else:
+            self.ftp_uploader = FTPUploader(self.ftp_host, self.ftp_user, config["ftp_password"], self.logger,
+                                            self.metrics, config["upload_blocksize"], config["ftp_port"])
+        if config["capture_backend"] == "screen":
+            capture_backend = ScreenCaptureBackend(config["capture_region"])
+        else:
+            capture_backend = ClipboardCaptureBackend()
+        encoder = ImageEncoder(config["encode_profile"], workers=config["encode_workers"])
+        preprocessor = ImagePreprocessor(**{**encoder.preprocess, **(config["preprocess"] or {})})
+        self.screenshot_manager = ScreenshotManager(self.ftp_uploader, self.logger, encoder, capture_backend, preprocessor)
+        self.screenshot_manager.filename_pattern = config["filename_pattern"]
+        if config["incremental"]:
+            from screenshot_ftp_delta import TileDeltaEncoder
+            self.screenshot_manager.tile_delta = TileDeltaEncoder(config["incremental_tile"], config["keyframe_interval"])
+        self.destinations = [create_destination(spec, self.logger, self.metrics, config["upload_blocksize"],
+                                                self.ftp_engine, config["upload_concurrency"])
+                             for spec in config["destinations"]]
+        if config["upload_rate_limit"]:
+            limiter = BandwidthLimiter(config["upload_rate_limit"] * 1024, config["upload_rate_adaptive"],
+                                       metrics=self.metrics)
+            for destination in [self.ftp_uploader] + self.destinations:
+                if hasattr(destination, "limiter"):
+                    destination.limiter = limiter
+        self.upload_spool = UploadSpool(get_app_data_dir("spool"), self.logger,
+                                        [self.ftp_uploader.name] + [destination.name for destination in self.destinations])
+        self.duplicate_cache = DuplicateCache(path=os.path.join(get_app_data_dir(), "recent_hashes.json"))
+        frame_budget = None
+        if config["memory_budget_mb"]:
+            frame_budget = FrameBudget(config["memory_budget_mb"] * 1024 * 1024, self.logger, config["memory_policy"],
+                                       get_app_data_dir("spill"), self.metrics)
+        # asyncio上传时一个上传线程取出的一批截图会同时上传，不需要多个上传线程
+        upload_workers = 1 if self.ftp_engine else 2
+        self.upload_pipeline = UploadPipeline(self.screenshot_manager, self.ftp_uploader, self.upload_spool, self.logger,
+                                              max_pending=config["max_pending"], upload_workers=upload_workers,
+                                              metrics=self.metrics, duplicate_cache=self.duplicate_cache,
+                                              duplicate_policy=config["duplicate_policy"],
+                                              stream_upload=config["stream_upload"],
+                                              batch_window=config["batch_window"],
+                                              batch_max_items=config["batch_max_items"],
+                                              batch_max_bytes=config["batch_max_bytes"],
+                                              batch_archive=config["batch_archive"],
+                                              destinations=self.destinations,
+                                              remote_layout=config["remote_layout"], frame_budget=frame_budget)
+        self.upload_pipeline.upload_finished.connect(self.on_upload_finished)
         self.keyboard_listener = KeyboardListener(self.logger)
         self.keyboard_listener.screenshot_taken.connect(self.on_screenshot)
-        
-        # 设置UI
-        self.setWindowTitle("截图FTP上传工具 - 南安专用版")
-        self.setGeometry(300, 300, 600, 500)
-        
-        # 创建分割器
-        splitter = QSplitter(Qt.Vertical)
-        self.setCentralWidget(splitter)
-        
-        # 上半部分控制面板
-        control_widget = QWidget()
-        control_layout = QVBoxLayout(control_widget)
-        
-        # 添加标签
-        info_label = QLabel("按下Print Screen键自动上传截图到FTP服务器")
-        info_label.setStyleSheet("font-weight: bold; font-size: 12pt;")
-        control_layout.addWidget(info_label)
-        
-        # FTP配置信息标签
-        self.ftp_info_label = QLabel(f"FTP服务器: {self.ftp_host}\n目录: /南安/ (将自动查找正确编码的路径)")
-        control_layout.addWidget(self.ftp_info_label)
-        
-        # 状态标签
-        self.status_label = QLabel("状态: 未运行")
-        self.status_label.setStyleSheet("font-weight: bold;")
-        control_layout.addWidget(self.status_label)
-        
-        # 按钮区域 - 使用水平布局
-        button_layout = QHBoxLayout()
-        
-        # 添加测试连接按钮
-        self.test_button = QPushButton("测试FTP连接")
-        self.test_button.setMinimumHeight(30)
-        self.test_button.clicked.connect(self.test_ftp_connection)
-        button_layout.addWidget(self.test_button)
-        
-        # 添加开始按钮
-        self.start_button = QPushButton("开始监听")
-        self.start_button.setMinimumHeight(30)
-        self.start_button.clicked.connect(self.start_monitoring)
-        button_layout.addWidget(self.start_button)
-        
-        # 添加停止按钮
-        self.stop_button = QPushButton("停止监听")
-        self.stop_button.setMinimumHeight(30)
-        self.stop_button.clicked.connect(self.stop_monitoring)
-        self.stop_button.setEnabled(False)
-        button_layout.addWidget(self.stop_button)
-        
-        # 添加清除日志按钮
-        self.clear_log_button = QPushButton("清除日志")
-        self.clear_log_button.setMinimumHeight(30)
-        self.clear_log_button.clicked.connect(self.clear_log)
-        button_layout.addWidget(self.clear_log_button)
-        
-        control_layout.addLayout(button_layout)
-        
-        # 下半部分日志窗口
-        self.log_widget = LogWidget()
-        self.logger.log_signal.connect(self.log_widget.append_log)
-        
-        # 添加到分割器
-        splitter.addWidget(control_widget)
-        splitter.addWidget(self.log_widget)
-        splitter.setSizes([150, 350])  # 设置初始大小比例
-        
-        # 创建系统托盘图标
-        self.create_tray_icon()
+        self.clipboard_watcher = ClipboardWatcher(self.clipboard_timeout)
+        self.clipboard_watcher.image_ready.connect(
+            lambda marks: self.grab_screenshot(marks, self.screenshot_manager.clipboard_backend))
+        self.clipboard_watcher.timed_out.connect(self.on_clipboard_timeout)
         
         # 监听状态
         self.is_monitoring = False
+        self.closed = False
         
         # 测试线程
         self.test_thread = None
+        self.revalidate_thread = None
+    
+    def start(self):
+        """启动后台线程并加载缓存的上传目录，返回是否已有可用目录"""
+        self.metrics_exporter.start()
+        self.screenshot_manager.encoder.start()
+        self.upload_pipeline.start()
         
         # 初始日志
         self.logger.info("程序已启动，针对\"/南安/\"目录的特殊版本")
         self.logger.info("运行于 " + ("Linux系统" if IS_LINUX else "Windows系统"))
-        self.logger.info("请点击\"测试FTP连接\"按钮测试连接")
+        if self.destinations:
+            self.logger.info("附加上传目标: " + "，".join(destination.name for destination in self.destinations))
+        pending = self.upload_spool.pending_count()
+        if pending:
+            self.logger.info(f"本地缓存中有 {pending} 个未上传的截图，确定工作目录后将继续上传")
+        
+        # 使用上次验证通过的目录，跳过目录探测
+        cached = load_ftp_cache(self.ftp_host, self.ftp_user)
+        if not cached:
+            return False
+        self.ftp_uploader.pool.encoding = cached.get("encoding", "gbk")
+        self.ftp_uploader.working_directory = cached["working_directory"]
+        self.directory_changed.emit()
+        self.logger.info(f"使用缓存的上传目录: {cached['working_directory']}，正在后台验证")
+        self.revalidate_ftp_directory()
+        return True
     
-    def update_directory_info(self):
-        """更新目录信息显示"""
-        if self.ftp_uploader.working_directory:
-            self.ftp_info_label.setText(f"FTP服务器: {self.ftp_host}\n目录: {self.ftp_uploader.working_directory} (已验证可上传)")
+    def revalidate_ftp_directory(self):
+        """在后台验证缓存的上传目录"""
+        self.revalidate_thread = self.ftp_uploader.revalidate()
+        
+        def on_revalidate_finished(valid, message):
+            if valid:
+                self.logger.info(message)
+                return
+            self.logger.warning(message)
+            save_ftp_cache(self.ftp_host, self.ftp_user, None, None)
+            self.ftp_uploader.working_directory = None
+            if self.is_monitoring:
+                self.stop_monitoring()
+            self.directory_changed.emit()
         
-    def clear_log(self):
-        """清除日志窗口内容"""
-        self.log_widget.clear()
-        self.logger.info("日志已清除")
+        self.revalidate_thread.finished.connect(on_revalidate_finished)
+        self.revalidate_thread.start()
     
     def test_ftp_connection(self):
-        """测试FTP连接，使用线程避免UI阻塞"""
-        self.test_button.setEnabled(False)
-        self.test_button.setText("正在测试连接...")
-        
-        # 获取测试线程
+        """在后台探测可上传的目录，结果通过test_finished通知"""
         self.test_thread = self.ftp_uploader.test_connection()
         
-        # 连接线程完成信号
         def on_test_finished(success, message):
-            """当测试线程完成时处理结果"""
-            # 更新UI状态
-            self.test_button.setText("测试FTP连接")
-            self.test_button.setEnabled(True)
-            
-            # 显示结果
             if success:
-                QMessageBox.information(self, "连接测试", message)
-                # 更新FTP上传器的工作目录
+                # 更新FTP上传器的工作目录，并缓存供下次启动使用
+                self.ftp_uploader.pool.encoding = self.test_thread.encoding
                 self.ftp_uploader.working_directory = self.test_thread.working_directory
-                self.update_directory_info()
-            else:
-                QMessageBox.critical(self, "连接测试", message)
+                save_ftp_cache(self.ftp_host, self.ftp_user, self.test_thread.working_directory, self.test_thread.encoding)
+                self.directory_changed.emit()
             
             # 清理线程
             self.test_thread.quit()
             self.test_thread.wait()
+            self.test_finished.emit(success, message)
         
-        # 连接信号
         self.test_thread.finished.connect(on_test_finished)
-        
-        # 启动线程
         self.test_thread.start()
     
-    def create_tray_icon(self):
-        # 创建托盘图标菜单
-        tray_menu = QMenu()
-        show_action = QAction("显示", self)
-        show_action.triggered.connect(self.show)
-        tray_menu.addAction(show_action)
-        
-        quit_action = QAction("退出", self)
-        quit_action.triggered.connect(self.close_application)
-        tray_menu.addAction(quit_action)
-        
-        # 创建托盘图标
-        self.tray_icon = QSystemTrayIcon(self)
-        self.tray_icon.setToolTip("截图FTP上传工具")
-        self.tray_icon.setContextMenu(tray_menu)
-        
-        # 设置图标并显示
-        if IS_LINUX:
-            # 在Linux上使用QIcon.fromTheme
-            icon = QIcon.fromTheme("accessories-screenshot", QIcon.fromTheme("image"))
-            if icon.isNull():
-                icon = self.style().standardIcon(QStyle.SP_ComputerIcon)
-        else:
-            # 在Windows上使用标准图标
-            icon = self.style().standardIcon(QStyle.SP_MessageBoxInformation)
-            
-        self.tray_icon.setIcon(icon)
-        self.tray_icon.show()
-    
     def start_monitoring(self):
-        # 检查是否已找到工作目录
+        """开始监听截图键，尚未确定工作目录时返回False"""
         if not self.ftp_uploader.working_directory:
             self.logger.warning("尚未找到可用的工作目录，请先测试FTP连接")
-            QMessageBox.warning(self, "缺少工作目录", "请先点击\"测试FTP连接\"按钮，确认可用的上传目录。")
-            return
+            return False
         
-        self.logger.info("开始监听Print Screen键")
         self.keyboard_listener.start_listening()
         self.is_monitoring = True
-        self.status_label.setText("状态: 正在监听Print Screen键")
-        self.status_label.setStyleSheet("font-weight: bold; color: green;")
-        self.start_button.setEnabled(False)
-        self.stop_button.setEnabled(True)
-        self.test_button.setEnabled(False)
-        
-        # 最小化到托盘
-        self.hide()
-        self.tray_icon.showMessage("截图上传工具", "程序正在后台运行，按Print Screen键上传截图", QSystemTrayIcon.Information, 2000)
+        self.monitoring_changed.emit(True)
+        return True
     
     def stop_monitoring(self):
-        self.logger.info("停止监听Print Screen键")
         self.keyboard_listener.stop_listening()
         self.is_monitoring = False
-        self.status_label.setText("状态: 未运行")
-        self.status_label.setStyleSheet("font-weight: bold;")
-        self.start_button.setEnabled(True)
-        self.stop_button.setEnabled(False)
-        self.test_button.setEnabled(True)
+        self.monitoring_changed.emit(False)
     
-    def on_screenshot(self):
+    def on_screenshot(self, key_time):
         self.logger.info("检测到截图，准备处理...")
-        success, filename = self.screenshot_manager.capture_and_upload()
+        marks = {"key_event": key_time}
+        if not self.screenshot_manager.capture_backend.uses_clipboard:
+            marks["clipboard_ready"] = time.monotonic()
+            self.grab_screenshot(marks)
+            return
+        
+        # 等待系统完成截图并复制到剪贴板，不阻塞事件循环
+        self.logger.info("等待剪贴板中出现新的截图")
+        self.clipboard_watcher.request(marks)
+    
+    def on_clipboard_timeout(self, marks):
+        self.logger.warning(f"{self.clipboard_timeout:.0f}秒内剪贴板中没有出现新的截图")
+        self.on_upload_finished(False, "剪贴板中没有新的截图")
+    
+    def grab_screenshot(self, marks, backend=None):
+        """在GUI线程获取截图，编码和上传交给后台流水线"""
+        image, error = self.screenshot_manager.grab_image(backend)
+        marks["grabbed"] = time.monotonic()
+        if image is None:
+            if backend is None and not self.screenshot_manager.capture_backend.uses_clipboard:
+                self.logger.warning("直接截屏失败，改为等待剪贴板中的截图")
+                self.clipboard_watcher.request(marks)
+                return
+            self.on_upload_finished(False, error)
+            return
+        if not self.upload_pipeline.submit(image, marks):
+            self.on_upload_finished(False, "待处理的截图过多")
+    
+    def on_upload_finished(self, success, filename):
         if success:
             self.logger.success(f"截图已成功上传: {filename}")
-            self.tray_icon.showMessage("截图已上传", f"截图已成功上传到FTP: {filename}", QSystemTrayIcon.Information, 2000)
         else:
             self.logger.error(f"截图上传失败: {filename}")
-            self.tray_icon.showMessage("上传失败", f"截图上传失败: {filename}", QSystemTrayIcon.Warning, 2000)
+        self.capture_finished.emit(success, filename)
     
-    def closeEvent(self, event):
-        # 拦截关闭事件，最小化到托盘而不是关闭
+    def close(self):
+        """停止监听和所有后台线程，可重复调用（退出菜单和应用程序退出时都会调用）"""
+        if self.closed:
+            return
+        self.closed = True
         if self.is_monitoring:
-            event.ignore()
-            self.hide()
-            self.tray_icon.showMessage("截图上传工具", "程序已最小化到系统托盘", QSystemTrayIcon.Information, 2000)
-        else:
-            event.accept()
-    
-    def close_application(self):
-        # 实际关闭应用程序
-        self.logger.info("正在关闭程序...")
-        self.stop_monitoring()
+            self.stop_monitoring()
         
         # 停止并等待任何正在运行的线程
         if self.test_thread and self.test_thread.isRunning():
             self.test_thread.quit()
             self.test_thread.wait()
-            
-        QApplication.quit()
+        if self.revalidate_thread and self.revalidate_thread.isRunning():
+            self.revalidate_thread.wait()
+        
+        # 等待上传流水线中的截图处理完成
+        self.upload_pipeline.stop()
+        self.screenshot_manager.encoder.close()
+        self.ftp_uploader.close()
+        for destination in self.destinations:
+            destination.close()
+        if self.ftp_engine:
+            self.ftp_engine.close()
+        self.metrics_exporter.stop()
+        
+        # 最后写出剩余的日志
+        self.logger.close()
 
-if __name__ == "__main__":
-    app = QApplication(sys.argv)
+def print_log(message, level):
+    """命令行模式下将日志输出到标准错误"""
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] [{level}] {message}", file=sys.stderr, flush=True)
+
+def find_working_directory(ftp_uploader, logger):
+    """在当前线程中确定上传目录，优先使用缓存，否则同步探测"""
+    pool = ftp_uploader.pool
+    cached = load_ftp_cache(pool.host, pool.user)
+    if cached:
+        pool.encoding = cached.get("encoding", "gbk")
+        ftp_uploader.working_directory = cached["working_directory"]
+        return True
+    
+    test_thread = ftp_uploader.test_connection()
+    result = {}
+    test_thread.log_signal.disconnect()
+    # 没有事件循环，信号必须直接调用
+    test_thread.log_signal.connect(logger.log, Qt.DirectConnection)
+    test_thread.finished.connect(lambda success, message: result.update(success=success, message=message),
+                                 Qt.DirectConnection)
+    test_thread.run()
+    if not result.get("success"):
+        logger.error(result.get("message", "未找到可上传的目录"))
+        return False
+    pool.encoding = test_thread.encoding
+    ftp_uploader.working_directory = test_thread.working_directory
+    save_ftp_cache(pool.host, pool.user, test_thread.working_directory, test_thread.encoding)
+    return True
+
+def run_upload(config, args):
+    """命令行上传单个文件，不加载界面库，返回进程退出码"""
+    logger = Logger()
+    logger.log_signal.connect(print_log, Qt.DirectConnection)
+    ftp_uploader = FTPUploader(config["ftp_host"], config["ftp_user"], config["ftp_password"], logger,
+                               blocksize=config["upload_blocksize"], port=config["ftp_port"])
+    try:
+        if args.file == "-":
+            data = sys.stdin.buffer.read()
+            source_name = "stdin"
+        else:
+            with open(args.file, "rb") as f:
+                data = f.read()
+            source_name = os.path.basename(args.file)
+        
+        if args.raw:
+            # 原样上传，不重新编码
+            filename = args.name or source_name
+            payload = io.BytesIO(data)
+        else:
+            from PIL import Image
+            encoder = ImageEncoder(args.profile or config["encode_profile"])
+            preprocessor = ImagePreprocessor(**{**encoder.preprocess, **(config["preprocess"] or {})})
+            manager = ScreenshotManager(ftp_uploader, logger, encoder, preprocessor=preprocessor)
+            manager.filename_pattern = config["filename_pattern"]
+            payload = io.BytesIO()
+            encoder.encode(manager.preprocess(Image.open(io.BytesIO(data))), payload)
+            filename = args.name or manager.make_filename(encoder.extension)
+        
+        if not find_working_directory(ftp_uploader, logger):
+            return 1
+        return 0 if ftp_uploader.upload_image(payload, remote_path(config["remote_layout"], filename)) else 1
+    except Exception as e:
+        logger.error(f"上传失败: {e}")
+        return 1
+    finally:
+        ftp_uploader.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="截图FTP上传工具 - 南安专用版")
+    parser.add_argument("--config", help=f"配置文件路径（默认: {os.path.join(get_app_config_dir(), CONFIG_FILE)}）")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("gui", help="显示主窗口（默认）")
+    subparsers.add_parser("daemon", help="无窗口运行，只显示托盘图标并自动开始监听")
+    upload_parser = subparsers.add_parser("upload", help="上传一个图像文件后退出")
+    upload_parser.add_argument("file", help="图像文件路径，- 表示从标准输入读取")
+    upload_parser.add_argument("--name", help="上传后的文件名（默认按时间生成）")
+    upload_parser.add_argument("--profile", choices=sorted(ENCODER_PROFILES), help="图像编码方案")
+    upload_parser.add_argument("--raw", action="store_true", help="不重新编码，原样上传文件")
+    bench_parser = subparsers.add_parser("bench", help="在本机模拟FTP服务器上测试截图上传性能（需要pyftpdlib）")
+    bench_parser.add_argument("--count", type=int, default=20, help="每种尺寸的截图次数（--startup 时为启动次数）")
+    bench_parser.add_argument("--startup", action="store_true",
+                              help="只测试启动耗时：在新进程中导入各模块，不启动模拟FTP服务器")
+    bench_parser.add_argument("--qimage", action="store_true",
+                              help="只测试QImage（RGB32/ARGB32/RGBA8888）转换为PIL图像和编码，不启动模拟FTP服务器")
+    bench_parser.add_argument("--sizes", help="截图尺寸，如 1920x1080,3840x2160")
+    bench_parser.add_argument("--profile", choices=sorted(ENCODER_PROFILES), default="default", help="图像编码方案")
+    bench_parser.add_argument("--interval", type=float, default=0.0, help="两次截图之间的间隔（秒），0为连续截图")
+    bench_parser.add_argument("--stream", action="store_true", help="边编码边上传（stream_upload）")
+    bench_parser.add_argument("--blocksize", type=float, default=64, help="STOR每次发送的块大小（KB）")
+    bench_parser.add_argument("--encode-workers", type=int, default=0, help="PNG多进程编码的进程数")
+    bench_parser.add_argument("--edits", action="store_true", help="连续截图只有小块区域改动，模拟同一操作员的截图")
+    bench_parser.add_argument("--incremental", action="store_true", help="使用增量上传（需要numpy）")
+    bench_parser.add_argument("--memory-budget", type=float, help="排队截图的内存预算（MB）")
+    bench_parser.add_argument("--memory-policy", choices=FrameBudget.POLICIES, default="spill",
+                              help="超出内存预算时的处理方式")
+    bench_parser.add_argument("--upload-workers", type=int, default=2, help="上传线程数")
+    bench_parser.add_argument("--engine", choices=("ftplib", "asyncio"), default="ftplib", help="上传方式")
+    bench_parser.add_argument("--concurrency", type=int, default=4, help="asyncio上传时同时上传的会话数")
+    bench_parser.add_argument("--latency", type=float, default=0.0, help="服务器每条命令的延迟（毫秒）")
+    bench_parser.add_argument("--bandwidth", type=float, help="服务器接收速率上限（KB/s）")
+    bench_parser.add_argument("--rate-limit", type=float, help="客户端上传限速（KB/s）")
+    bench_parser.add_argument("--failure-rate", type=float, default=0.0, help="STOR失败的概率 (0-1)")
+    bench_parser.add_argument("--drop-rate", type=float, default=0.0,
+                              help="服务器每次接收数据后断开会话的概率，用于测试断点续传")
+    bench_parser.add_argument("--output", help="将结果写入JSON文件")
+    bench_parser.add_argument("--save-baseline", help="将结果保存为基准文件")
+    bench_parser.add_argument("--baseline", help="与基准文件对比，退化超过容差时返回1")
+    bench_parser.add_argument("--tolerance", type=float, default=0.2, help="允许的退化比例（默认0.2）")
+    bench_parser.add_argument("-v", "--verbose", action="store_true", help="输出上传日志")
+    rebuild_parser = subparsers.add_parser("rebuild", help="用关键帧和增量文件还原完整截图（需要numpy）")
+    rebuild_parser.add_argument("directory", help="从FTP服务器下载的截图目录（包括按日期分的子目录）")
+    rebuild_parser.add_argument("--output", help="输出目录（默认: 截图目录下的rebuilt）")
+    args = parser.parse_args(argv)
     
-    # 设置应用程序样式
-    app.setStyle('Fusion')
+    if args.command == "bench":
+        from screenshot_ftp_bench import run_bench
+        return run_bench(args)
+    if args.command == "rebuild":
+        from screenshot_ftp_delta import run_rebuild
+        return run_rebuild(args)
     
-    window = MainWindow()
-    window.show()
-    sys.exit(app.exec_()) 
\ No newline at end of file
+    config = load_config(args.config)
+    if args.command == "upload":
+        return run_upload(config, args)
+    
+    # 只有界面和后台模式需要加载QtWidgets
+    from screenshot_ftp_gui import run_gui, run_daemon
+    if args.command == "daemon":
+        return run_daemon(config)
+    return run_gui(config)
+
+if __name__ == "__main__":
+    # 打包后的程序中启动多进程编码的工作进程
+    import multiprocessing
+    multiprocessing.freeze_support()
+    # 界面模块按模块名导入本文件，避免作为脚本运行时被再次加载
+    sys.modules.setdefault("screenshot_ftp_nanAn_kylin", sys.modules["__main__"])
+    sys.exit(main())